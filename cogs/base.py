@@ -5,30 +5,11 @@
 import discord
 import platform
 import random
-import json
-import json5
-import os
 
 from discord.ext import commands
 from random import randint
 
-# Files for bot data and configuration
-DB_FILE = 'db.json'
-CONFIG_FILE = 'config.json5'
-
-# Load configuration data
-def load_config():
-    if not os.path.exists(CONFIG_FILE):
-        return {}
-    with open(CONFIG_FILE, 'r') as f:
-        return json5.load(f)
-
-def get_setting(key, default=None):
-    config = load_config()
-    return config.get(key, default)
-
-# Get owner ID from config
-ownerID = get_setting('owner_id', 0)
+from util.config import get_settings
 
 class Base(commands.Cog):
 
@@ -71,6 +52,7 @@ class Base(commands.Cog):
         dpyVersion = discord.__version__
         serverCount = len(self.bot.guilds)
         memberCount = len(set(self.bot.get_all_members()))
+        ownerID = get_settings().owner_id
 
         embed = discord.Embed(
             title=f'FloofBot Stats',
@@ -1,193 +1,298 @@
 import discord
-from discord.ext import commands, tasks
-import json
-import json5
-import os
-from datetime import datetime, timedelta
-import asyncio
+from discord.ext import commands
+from datetime import date, datetime, timedelta
 import pytz
 
-# Files for bot data and configuration
-DB_FILE = 'db.json'
-CONFIG_FILE = 'config.json5'
-
-# Load configuration data
-def load_config():
-    if not os.path.exists(CONFIG_FILE):
-        return {}
-    with open(CONFIG_FILE, 'r') as f:
-        return json5.load(f)
-
-def get_setting(key, default=None):
-    config = load_config()
-    return config.get(key, default)
-
-# Load or initialize database data
-def load_db():
-    if not os.path.exists(DB_FILE):
-        return {"quotes": [], "birthdays": {}, "levels": {}}
-    with open(DB_FILE, 'r') as f:
-        return json.load(f)
-
-def save_db(data):
-    with open(DB_FILE, 'w') as f:
-        json.dump(data, f, indent=4)
-
-# Load birthday data from unified database
-def load_birthdays():
-    data = load_db()
-    return data.get('birthdays', {})
-
-def save_birthdays(birthday_data):
-    data = load_db()
-    data['birthdays'] = birthday_data
-    save_db(data)
-
-# Initialize birthday data
-birthday_data = load_birthdays()
+from util.birthdays import BirthdayIndex, BirthdaySettingsCache, days_in_month, parse_birthday
+from util.config import get_settings
+from util.scheduler import local_midnight, next_local_midnight
+
+# Most past days replayed after downtime
+MAX_CATCH_UP_DAYS = 7
+# Seconds the month and day prompts of /set_birthday keep working
+BIRTHDAY_PROMPT_SECONDS = 300
+
+MONTHS = ["January", "February", "March", "April", "May", "June",
+          "July", "August", "September", "October", "November", "December"]
 
 class Birthday(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
-        self.check_birthdays.start()  # Start the birthday check task
+        self.storage = bot.storage
+        self.scheduler = bot.scheduler
+        self.checkpoints = bot.checkpoints  # Remembers the last midnight handled, for catching up after downtime
+        self.rollover_job = None
+        bot.router.add('bdm', self.on_birthday_month)
+        bot.router.add('bdd', self.on_birthday_day)
+        self.guild_settings = BirthdaySettingsCache(self.storage)  # Channel and role of each guild
+        self.indexes = {}  # Guild ID -> BirthdayIndex of the members who opted in there
+        for guild_id, entry in self.storage.birthday_guilds.items():
+            for user_id in entry.get('members', []):
+                self.index_member(guild_id, user_id)
+
+    def index_member(self, guild_id, user_id):
+        birthday = self.storage.birthdays.get(str(user_id))
+        if birthday:
+            index = self.indexes.get(guild_id)
+            if index is None:
+                index = self.indexes[guild_id] = BirthdayIndex()
+            index.set(user_id, *parse_birthday(birthday))
+
+    def guild_entry(self, guild_id):
+        """The guild's birthday_guilds entry, created empty if it has none yet."""
+        entry = self.storage.birthday_guilds.get(guild_id)
+        if entry is None:
+            entry = self.storage.birthday_guilds[guild_id] = {"channel_id": 0, "role_id": 0, "members": []}
+        return entry
+
+    def set_opt_in(self, guild_id, user_id, enabled):
+        """Add or remove a member from the guild's birthday announcements; returns whether anything changed."""
+        members = self.guild_entry(guild_id).setdefault('members', [])
+        if enabled == (user_id in members):
+            return False
+        if enabled:
+            members.append(user_id)
+            self.index_member(guild_id, user_id)
+        else:
+            members.remove(user_id)
+            if guild_id in self.indexes:
+                self.indexes[guild_id].remove(user_id)
+        self.storage.save(('birthday_guilds', guild_id))
+        return True
+
+    def cog_unload(self):
+        if self.rollover_job is not None:
+            self.scheduler.cancel(self.rollover_job)
+        self.bot.router.remove('bdm')
+        self.bot.router.remove('bdd')
 
     @commands.slash_command()
     async def set_birthday(self, ctx):
         """Set your birthday using a dropdown for month and input for day."""
         # Create month options
-        month_options = [discord.SelectOption(label=month, value=str(index + 1)) for index, month in enumerate([
-            "January", "February", "March", "April", "May", "June",
-            "July", "August", "September", "October", "November", "December"
-        ])]
+        month_options = [discord.SelectOption(label=month, value=str(index + 1)) for index, month in enumerate(MONTHS)]
 
-        # Create dropdown for month
-        month_select = discord.ui.Select(placeholder="Select your birth month", options=month_options)
+        # Create dropdown for month; the router sends the pick to on_birthday_month
+        month_select = discord.ui.Select(placeholder="Select your birth month", options=month_options,
+                                         custom_id=self.bot.router.custom_id('bdm', ctx.author.id, timeout=BIRTHDAY_PROMPT_SECONDS))
 
         # Create a view to hold the month dropdown
-        view = discord.ui.View()
-        view.add_item(month_select)
+        view = discord.ui.View(month_select, timeout=None, store=False)
 
         # Send the month dropdown to the channel
         await ctx.respond("Please select your birth month:", view=view)
 
-        # Wait for the user to select a month
-        def check_month(interaction):
-            return interaction.user == ctx.author and interaction.data['component_type'] == 3  # 3 is the type for Select
+    async def on_birthday_month(self, interaction, user_id):
+        if interaction.user.id != int(user_id):
+            await interaction.response.send_message("Use /set_birthday to set your own birthday.", ephemeral=True)
+            return
+        month = int(interaction.data['values'][0])  # Get the selected month
 
-        try:
-            month_interaction = await self.bot.wait_for("interaction", check=check_month, timeout=60.0)
-            month = int(month_select.values[0])  # Get the selected month
-
-            # Acknowledge the month selection
-            await month_interaction.response.send_message(f"You selected: {month_options[month - 1].label}. Please type your birth day (1-31):", ephemeral=True)
-
-            # Wait for the user to respond with the day in the channel
-            def check_day(message):
-                return message.author == ctx.author and message.channel == ctx.channel
-
-            day_message = await self.bot.wait_for("message", check=check_day, timeout=60.0)
-            day = day_message.content.strip()
-
-            # Validate the day input
-            if not day.isdigit() or not (1 <= int(day) <= 31):
-                await ctx.channel.send(f"{ctx.author.mention}, please enter a valid day between 1 and 31.")
-                return
-
-            # Format the birthday as YYYY-MM-DD
-            birthday = f"2023-{month:02}-{int(day):02}"  # Using a fixed year for simplicity
-
-            # Extract month name for the response
-            month_name = ["January", "February", "March", "April", "May", "June",
-                          "July", "August", "September", "October", "November", "December"][month - 1]
-            formatted_birthday = f"{month_name} {int(day)}"
-
-            user_id = str(ctx.author.id)
-            birthday_data[user_id] = birthday
-            save_birthdays(birthday_data)
-
-            # Send the confirmation message in the channel
-            await ctx.channel.send(f"🎉 {ctx.author.mention}, your birthday has been set to {formatted_birthday}!")
-
-        except Exception as e:
-            # Handle the error gracefully
-            if isinstance(e, discord.errors.NotFound):
-                await ctx.channel.send(f"{ctx.author.mention}, an error occurred while processing your request. Please try again.")
-            else:
-                await ctx.channel.send(f"{ctx.author.mention}, you took too long to respond or an error occurred.")
-
-    @tasks.loop(hours=24)  # Check every 24 hours
-    async def check_birthdays(self):
-        # Get the current time in EST
-        est = pytz.timezone('America/New_York')
-        now = datetime.now(est)
-
-        # Check if it's 12 AM
-        if now.hour == 0 and now.minute == 0:
-            today = now.strftime("%Y-%m-%d")
-            yesterday = (now - timedelta(days=1)).strftime("%Y-%m-%d")
-            birthday_role_id = get_setting('birthday_role_id')
-            
-            # Check for users whose birthday is today
-            for user_id, birthday in birthday_data.items():
-                if birthday == today:
-                    user = self.bot.get_user(int(user_id))
-                    if user:
-                        # Send birthday message
-                        channel_id = get_setting('birthday_channel_id')
-                        if channel_id:
-                            channel = self.bot.get_channel(int(channel_id))
-                            if channel:
-                                await channel.send(f"🎉 Happy Birthday {user.mention}! 🎉")
-                        
-                        # Give birthday role if configured
-                        if birthday_role_id:
-                            # Try to find the user in any guild the bot is in
-                            for guild in self.bot.guilds:
-                                member = guild.get_member(int(user_id))
-                                if member:
-                                    birthday_role = guild.get_role(int(birthday_role_id))
-                                    if birthday_role and birthday_role not in member.roles:
-                                        try:
-                                            await member.add_roles(birthday_role)
-                                            # Send confirmation to the birthday channel
-                                            if channel_id:
-                                                channel = self.bot.get_channel(int(channel_id))
-                                                if channel:
-                                                    await channel.send(f"🎁 {user.mention} has been given the birthday role!")
-                                        except discord.Forbidden:
-                                            # Bot doesn't have permission to manage roles
-                                            pass
-                                        except Exception as e:
-                                            print(f"Error assigning birthday role: {e}")
-                                    break  # Found the user, no need to check other guilds
-            
-            # Check for users whose birthday was yesterday and remove the role
-            if birthday_role_id:
-                for user_id, birthday in birthday_data.items():
-                    if birthday == yesterday:
-                        # Try to find the user in any guild the bot is in
-                        for guild in self.bot.guilds:
-                            member = guild.get_member(int(user_id))
-                            if member:
-                                birthday_role = guild.get_role(int(birthday_role_id))
-                                if birthday_role and birthday_role in member.roles:
-                                    try:
-                                        await member.remove_roles(birthday_role)
-                                        # Send notification to the birthday channel
-                                        channel_id = get_setting('birthday_channel_id')
-                                        if channel_id:
-                                            channel = self.bot.get_channel(int(channel_id))
-                                            if channel:
-                                                await channel.send(f"👋 Birthday role removed from {member.mention}. See you next year!")
-                                    except discord.Forbidden:
-                                        # Bot doesn't have permission to manage roles
-                                        pass
-                                    except Exception as e:
-                                        print(f"Error removing birthday role: {e}")
-                                break  # Found the user, no need to check other guilds
+        # Ask for the day in a modal whose custom_id carries the month
+        last_day = days_in_month(month)
+        modal = discord.ui.Modal(
+            discord.ui.InputText(label=f"Day of {MONTHS[month - 1]} (1-{last_day})", min_length=1, max_length=2),
+            title="Set your birthday", store=False,
+            custom_id=self.bot.router.custom_id('bdd', month, user_id, timeout=BIRTHDAY_PROMPT_SECONDS))
+        await interaction.response.send_modal(modal)
+
+    async def on_birthday_day(self, interaction, month, user_id):
+        month = int(month)
+        day = interaction.data['components'][0]['components'][0]['value'].strip()
+
+        # Validate the day input
+        last_day = days_in_month(month)
+        if not day.isdigit() or not (1 <= int(day) <= last_day):
+            await interaction.response.send_message(f"Please enter a valid day between 1 and {last_day}.", ephemeral=True)
+            return
+
+        # Format the birthday as YYYY-MM-DD
+        birthday = f"2023-{month:02}-{int(day):02}"  # Using a fixed year for simplicity
+        formatted_birthday = f"{MONTHS[month - 1]} {int(day)}"
+
+        self.storage.birthdays[user_id] = birthday
+        self.storage.save(('birthdays', user_id))
+        # Move the birthday in every guild the user opted into, and opt them into this one
+        for guild_id, entry in self.storage.birthday_guilds.items():
+            if int(user_id) in entry.get('members', []):
+                self.index_member(guild_id, int(user_id))
+        if interaction.guild:
+            self.set_opt_in(str(interaction.guild.id), int(user_id), True)
+
+        # Replace the month prompt with the confirmation
+        await interaction.response.edit_message(
+            content=f"🎉 {interaction.user.mention}, your birthday has been set to {formatted_birthday}!", view=None)
+
+    @commands.slash_command()
+    async def birthday_announcements(self, ctx, enabled: bool):
+        """Choose whether your birthday is celebrated in this server."""
+        if enabled and str(ctx.author.id) not in self.storage.birthdays:
+            await ctx.respond("Set your birthday with /set_birthday first.", ephemeral=True)
+            return
+        self.set_opt_in(str(ctx.guild.id), ctx.author.id, enabled)
+        await ctx.respond("Your birthday will be celebrated in this server." if enabled
+                          else "Your birthday won't be celebrated in this server.", ephemeral=True)
+
+    @commands.slash_command()
+    @commands.has_role("STAFF")
+    async def birthday_setup(self, ctx, channel: discord.TextChannel = None, role: discord.Role = None):
+        """Set where this server announces birthdays and which role birthday members get."""
+        guild_id = str(ctx.guild.id)
+        entry = self.guild_entry(guild_id)
+        entry['channel_id'] = channel.id if channel else 0
+        entry['role_id'] = role.id if role else 0
+        self.storage.save(('birthday_guilds', guild_id))
+        self.guild_settings.invalidate(guild_id)
+        await ctx.respond(f"Birthdays will be announced in {channel.mention if channel else 'no channel'} "
+                          f"with {role.mention if role else 'no role'}.")
+
+    def migrate_global_settings(self):
+        """Carry the old global birthday_channel_id/birthday_role_id over to the guild they belong to."""
+        settings = get_settings()
+        channel = self.bot.get_channel(settings.birthday_channel_id) if settings.birthday_channel_id else None
+        guild = channel.guild if channel else None
+        if guild is None and settings.birthday_role_id:
+            guild = next((guild for guild in self.bot.guilds if guild.get_role(settings.birthday_role_id)), None)
+        if guild is None:
+            return
+        guild_id = str(guild.id)
+        entry = self.guild_entry(guild_id)
+        entry['channel_id'] = channel.id if channel else 0
+        entry['role_id'] = settings.birthday_role_id if guild.get_role(settings.birthday_role_id) else 0
+        # Everyone was announced there before, so every member with a birthday starts opted in
+        entry['members'] = [int(user_id) for user_id in self.storage.birthdays if guild.get_member(int(user_id))]
+        for user_id in entry['members']:
+            self.index_member(guild_id, user_id)
+        self.storage.save(('birthday_guilds', guild_id))
+        self.guild_settings.invalidate(guild_id)
+        print(f"Moved the global birthday settings to {guild.name} with {len(entry['members'])} members")
+
+    @commands.Cog.listener()
+    async def on_ready(self):
+        if not self.storage.birthday_guilds:
+            self.migrate_global_settings()
+        # on_ready repeats after reconnects; the rollover only needs setting up once
+        if self.rollover_job is None:
+            self.schedule_rollovers()
+
+    def schedule_rollovers(self):
+        """Catch up on midnights missed while the bot was down, then schedule the next one."""
+        tz = pytz.timezone(get_settings().timezone)
+        today = datetime.now(tz).date()
+        last = self.checkpoints.get('scheduler', 'birthday_rollover')
+        last = date.fromisoformat(last) if last else today - timedelta(days=1)
+        day = last + timedelta(days=1)
+        if day < today - timedelta(days=MAX_CATCH_UP_DAYS):
+            # A long outage only replays its last few days; the roles of the older birthdays are
+            # taken back in one sweep first, rather than a night at a time
+            self.scheduler.schedule(local_midnight(day, tz), self.revoke_stale_birthdays, today)
+            day = today - timedelta(days=MAX_CATCH_UP_DAYS)
+        while day < today:
+            self.scheduler.schedule(local_midnight(day, tz), self.rollover, day, True)
+            day += timedelta(days=1)
+        if last < today:
+            self.rollover_job = self.scheduler.schedule(local_midnight(today, tz), self.rollover, today)
         else:
-            await asyncio.sleep(60)
+            tomorrow, midnight = next_local_midnight(tz)
+            self.rollover_job = self.scheduler.schedule(midnight, self.rollover, tomorrow)
+
+    async def rollover(self, day, catch_up=False):
+        """Midnight job for day: take yesterday's birthday roles back and celebrate today's birthdays.
+
+        Catch-up runs for days that are already over only take roles back.
+        """
+        if not catch_up:
+            # Tomorrow is scheduled first so a failure below can't end the chain of midnights.
+            # The timezone is read again for every night, so changing it takes effect at the next midnight
+            tomorrow = day + timedelta(days=1)
+            self.rollover_job = self.scheduler.schedule(local_midnight(tomorrow, pytz.timezone(get_settings().timezone)), self.rollover, tomorrow)
+        try:
+            await self.revoke_birthdays(day - timedelta(days=1))
+            if not catch_up:
+                await self.grant_birthdays(day)
+        finally:
+            last = self.checkpoints.get('scheduler', 'birthday_rollover')
+            if last is None or date.fromisoformat(last) < day:
+                self.checkpoints.set('scheduler', 'birthday_rollover', day.isoformat())
+
+    async def grant_birthdays(self, day):
+        # One pass per guild over only the members celebrating today
+        for guild_id, index in list(self.indexes.items()):
+            guild = self.bot.get_guild(int(guild_id))
+            user_ids = index.users_on(day)
+            if guild is None or not user_ids:
+                continue
+            settings = self.guild_settings.get(guild_id)
+            channel = guild.get_channel(settings.channel_id) if settings.channel_id else None
+            birthday_role = guild.get_role(settings.role_id) if settings.role_id else None
+
+            for user_id in user_ids:
+                member = guild.get_member(user_id)
+                if not member:
+                    continue
+                # Send birthday message
+                if channel:
+                    try:
+                        await channel.send(f"🎉 Happy Birthday {member.mention}! 🎉")
+                    except discord.HTTPException as e:
+                        # One guild's missing permissions mustn't stop the others' birthdays
+                        print(f"Error sending birthday message in {guild.name}: {e}")
+
+                # Give birthday role if configured
+                if birthday_role and birthday_role not in member.roles:
+                    try:
+                        await member.add_roles(birthday_role)
+                        # Send confirmation to the birthday channel
+                        if channel:
+                            await channel.send(f"🎁 {member.mention} has been given the birthday role!")
+                    except discord.Forbidden:
+                        # Bot doesn't have permission to manage roles
+                        pass
+                    except Exception as e:
+                        print(f"Error assigning birthday role: {e}")
+
+    async def revoke_stale_birthdays(self, today):
+        # Take the role back from every holder who isn't celebrating today, however long ago their birthday was
+        for guild_id in list(self.storage.birthday_guilds):
+            guild = self.bot.get_guild(int(guild_id))
+            settings = self.guild_settings.get(guild_id)
+            birthday_role = guild and settings.role_id and guild.get_role(settings.role_id)
+            if not birthday_role:
+                continue
+            index = self.indexes.get(guild_id)
+            celebrating = index.users_on(today) if index else set()
+            for member in list(birthday_role.members):
+                if member.id in celebrating:
+                    continue
+                try:
+                    await member.remove_roles(birthday_role)
+                except discord.Forbidden:
+                    # Bot doesn't have permission to manage roles
+                    break
+                except Exception as e:
+                    print(f"Error removing birthday role: {e}")
+
+    async def revoke_birthdays(self, day):
+        # Take the role back from the members whose birthday was yesterday
+        for guild_id, index in list(self.indexes.items()):
+            guild = self.bot.get_guild(int(guild_id))
+            settings = self.guild_settings.get(guild_id)
+            user_ids = index.users_on(day)
+            if guild is None or not settings.role_id or not user_ids:
+                continue
+            channel = guild.get_channel(settings.channel_id) if settings.channel_id else None
+            birthday_role = guild.get_role(settings.role_id)
 
-    @check_birthdays.before_loop
-    async def before_check_birthdays(self):
-        await self.bot.wait_until_ready()
\ No newline at end of file
+            for user_id in user_ids:
+                member = guild.get_member(user_id)
+                if member and birthday_role in member.roles:
+                    try:
+                        await member.remove_roles(birthday_role)
+                        # Send notification to the birthday channel
+                        if channel:
+                            await channel.send(f"👋 Birthday role removed from {member.mention}. See you next year!")
+                    except discord.Forbidden:
+                        # Bot doesn't have permission to manage roles
+                        pass
+                    except Exception as e:
+                        print(f"Error removing birthday role: {e}")
@@ -3,217 +3,777 @@
 #***************************************************************************#
 
 import discord
-from discord.ext import commands
+from discord.ext import commands, tasks
+import asyncio
+import functools
 import json
-import json5
-import os
-
-# Files for bot data and configuration
-DB_FILE = 'db.json'
-CONFIG_FILE = 'config.json5'
-
-# Load configuration data
-def load_config():
-    if not os.path.exists(CONFIG_FILE):
-        return {}
-    with open(CONFIG_FILE, 'r') as f:
-        return json5.load(f)
-
-def get_setting(key, default=None):
-    config = load_config()
-    return config.get(key, default)
-
-# Load or initialize database data
-def load_db():
-    if not os.path.exists(DB_FILE):
-        return {"quotes": [], "birthdays": {}, "levels": {}}
-    with open(DB_FILE, 'r') as f:
-        return json.load(f)
-
-def save_db(data):
-    with open(DB_FILE, 'w') as f:
-        json.dump(data, f, indent=4)
-
-# Load levels data from unified database
-def load_levels():
-    data = load_db()
-    return data.get('levels', {})
-
-def save_levels(levels_data):
-    data = load_db()
-    data['levels'] = levels_data
-    save_db(data)
-
-# Initialize levels data
-levels_data = load_levels()
-
-# Function to calculate XP needed for the next level
-def xp_needed(level):
-    return ((500 * level) // 2)
+import sys
+import time
+
+from util.config import get_settings
+from util.cooldown import XpCooldowns
+from util.leaderboard import TOPS_FILE, GlobalLeaderboard, GuildTops, LeaderboardIndex, merge_top
+from util.archive import ARCHIVE_FILE, LevelArchive
+from util.backfill import XpBackfill
+from util.leveltable import LevelTable, level_for_xp, xp_for_level, xp_needed
+from util.role_sync import LevelRoles, RoleSync
+from util.voice import VoiceSessions
+
+# Checkpoint job holding the start time of every open voice session, by guild
+VOICE_JOB = 'voice_sessions'
+
+# Seconds the leaderboard's paging buttons keep working
+LEADERBOARD_PROMPT_SECONDS = 600
 
 class Leveling(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
+        self.storage = bot.storage
+        settings = get_settings()
+        self.pending_xp = {}  # Guild ID -> {User ID: XP awarded since the last flush}
+        self.pending_count = 0  # Number of dirty users in pending_xp
+        self.leaderboards = {}  # Guild ID -> LeaderboardIndex
+        self.global_leaderboard = GlobalLeaderboard(settings.global_leaderboard_size, settings.global_leaderboard_ttl)
+        # Each guild's best users, merged for the global leaderboard instead of every guild's whole table
+        self.tops_file = settings.get('leaderboard_tops_file', TOPS_FILE)
+        self.guild_tops = GuildTops(settings.global_leaderboard_size)
+        self.guild_tops.load(self.tops_file)
+        self.cooldowns = XpCooldowns()  # Per-user XP token buckets, checked before a message is queued
+        self.voice_sessions = {}  # Guild ID -> VoiceSessions of members earning voice XP right now, by Unix start time
+        self.voice_seconds = {}  # (Guild ID, User ID) -> voice time ended but not yet turned into XP
+        self.voice_live = False  # Whether voice state events are arriving, i.e. the gateway is connected
+        self.flush_lock = asyncio.Lock()
+        self.role_syncs = {}  # Guild ID -> RoleSync currently running there
+        self.backfills = {}  # Guild ID -> XpBackfill currently running there
+        self.checkpoints = bot.checkpoints
+        self.flush_xp_loop.change_interval(seconds=settings.xp_flush_interval)
+        self.flush_xp_loop.start()
+        # Messages waiting for XP; on_message only enqueues and xp_consumer applies them in batches
+        self.xp_queue = asyncio.Queue(maxsize=settings.xp_queue_size)
+        self.queue_metrics = {'batches': 0, 'messages': 0, 'full_waits': 0, 'max_depth': 0, 'cooldown_skips': 0,
+                              'last_latency': 0.0, 'avg_latency': 0.0, 'max_latency': 0.0}
+        self.xp_consumer.start()
+        bot.router.add('lb', self.on_leaderboard_page)
+        self.archive = LevelArchive(settings.get('level_archive_file', ARCHIVE_FILE))
+        self.retention_loop.change_interval(hours=settings.retention_interval_hours)
+        self.retention_loop.start()
+
+    def cog_unload(self):
+        self.flush_xp_loop.cancel()
+        self.xp_consumer.cancel()
+        self.retention_loop.cancel()
+        self.bot.router.remove('lb')
+        # Hand any buffered XP to the storage writer when the cog is removed
+        if self.pending_count:
+            self.storage.save(*self.take_pending())
+
+    def take_pending(self):
+        """Empty the XP buffer, returning the storage keys of every dirty user."""
+        pending, self.pending_xp = self.pending_xp, {}
+        self.pending_count = 0
+        return [('levels', guild_id, user_id) for guild_id, users in pending.items() for user_id in users]
+
+    def buffer_xp(self, guild_id, user_id, amount):
+        """Record an XP award that still has to be written to the database."""
+        guild_pending = self.pending_xp.setdefault(guild_id, {})
+        if user_id not in guild_pending:
+            guild_pending[user_id] = 0
+            self.pending_count += 1
+        guild_pending[user_id] += amount
+
+    async def flush_xp(self):
+        """Write buffered XP awards to the database in one pass."""
+        async with self.flush_lock:
+            if not self.pending_count:
+                return
+            self.storage.save(*self.take_pending())
+            await self.storage.flush()
+
+    @tasks.loop(seconds=30)
+    async def flush_xp_loop(self):
+        await self.settle_voice()
+        await self.flush_xp()
+        await self.save_guild_tops()
+        settings = get_settings()
+        # Nothing is buffered right after a flush, so idle guilds can safely leave memory
+        for guild_id in self.storage.evict_idle(settings.guild_idle_seconds):
+            self.leaderboards.pop(guild_id, None)
+        self.cooldowns.prune(time.monotonic())
+        if settings.xp_flush_interval != self.flush_xp_loop.seconds:
+            self.flush_xp_loop.change_interval(seconds=settings.xp_flush_interval)
+
+    @flush_xp_loop.before_loop
+    async def before_flush_xp_loop(self):
+        await self.bot.wait_until_ready()
+
+    async def leaderboard_index(self, guild_id):
+        """The guild's leaderboard index, built from storage the first time it's needed."""
+        guild_levels = await self.storage.guild_levels(guild_id)
+        index = self.leaderboards.get(guild_id)
+        if index is None:
+            index = self.leaderboards[guild_id] = LeaderboardIndex.build(guild_levels)
+        return index
+
+    async def award_xp(self, guild_id, user_id, amount, active=True):
+        """Give a user XP, keeping the leaderboard index current. Returns (level, leveled_up).
+
+        With active False (history being backfilled) the user's last award time is left alone.
+        """
+        guild_levels = await self.storage.guild_levels(guild_id)
+        old = guild_levels.get(user_id)
+        if old is None:
+            # An archived user (inactive, or back while the bot was offline) picks their XP up again first
+            await self.restore_users(guild_id, [user_id])
+            old = guild_levels.get(user_id)
+
+        # Start new users at level 1 with no XP
+        old_level, old_xp = old or (1, 0)
+        total_xp = old_xp + amount
+
+        # Levels follow from total XP, so a level-up is just crossing the next threshold
+        level = level_for_xp(total_xp)
+        leveled_up = level > old_level
+
+        guild_levels.set(user_id, level, total_xp, int(time.time()) if active else None)
+        index = self.leaderboards.get(guild_id)
+        if index is not None:
+            index.update(user_id, old and old_xp, total_xp)
+        self.global_leaderboard.award(total_xp)
+        self.guild_tops.update(guild_id, user_id, total_xp)
+        self.buffer_xp(guild_id, user_id, amount)
+        return level, leveled_up
+
+    @commands.Cog.listener()
+    async def on_ready(self):
+        # Rebuild the leaderboard indexes of every guild already in memory
+        for guild_id in list(self.storage.levels):
+            await self.leaderboard_index(guild_id)
+
+        self.reopen_voice_sessions()
+
+    @commands.Cog.listener()
+    async def on_resumed(self):
+        self.reopen_voice_sessions()
+
+    @commands.Cog.listener()
+    async def on_disconnect(self):
+        # Voice time up to the disconnect is real; what happens while disconnected can't be seen
+        if self.voice_live:
+            self.close_voice_sessions()
+            self.voice_live = False
+
+    def reopen_voice_sessions(self):
+        """Restart voice sessions from the members in voice right now, after a (re)connect.
+
+        Sessions ended by a disconnect were credited up to it and aren't
+        resumed, since members may have left at any point while the bot
+        couldn't see it. Sessions still saved in the checkpoints were cut
+        short by a crash; a member still in voice resumes theirs from its
+        saved start, and one who left can't be credited.
+        """
+        now = time.time()
+        self.voice_sessions = {}
+        # Members already in voice never sent a join event, so their sessions are opened here
+        for guild in self.bot.guilds:
+            saved = self.checkpoints.get(VOICE_JOB, guild.id, {})
+            for channel in guild.voice_channels:
+                for member in channel.members:
+                    if not member.bot and member.voice and self.earns_voice_xp(member.voice):
+                        sessions = self.voice_sessions.setdefault(str(guild.id), VoiceSessions())
+                        sessions.start(member.id, min(saved.get(str(member.id), now), now))
+        for guild_id in list(self.checkpoints.data.get(VOICE_JOB, {})):
+            self.checkpoints.clear(VOICE_JOB, guild_id)
+        for guild_id in self.voice_sessions:
+            self.save_voice_sessions(guild_id)
+        self.voice_live = True
+
+    def save_voice_sessions(self, guild_id):
+        """Checkpoint the start times of the guild's open sessions, so a crash doesn't lose them."""
+        sessions = self.voice_sessions.get(guild_id)
+        if sessions:
+            self.checkpoints.set(VOICE_JOB, guild_id, {str(user_id): started for user_id, started in sessions.items()})
+        else:
+            self.checkpoints.clear(VOICE_JOB, guild_id)
+
+    def close_voice_sessions(self):
+        """End every open session, crediting its time so far; they are reopened on the next (re)connect."""
+        now = time.time()
+        for guild_id, sessions in self.voice_sessions.items():
+            for user_id, seconds in sessions.stop_all(now):
+                self.add_voice_time(guild_id, user_id, seconds)
+            self.checkpoints.clear(VOICE_JOB, guild_id)
+        self.voice_sessions = {}
 
     @commands.Cog.listener()
     async def on_message(self, message):
-        if message.author.bot:
+        if message.author.bot or message.guild is None:
+            return
+
+        # Messages inside the user's cooldown are dropped before any queue or storage work
+        settings = get_settings()
+        now = time.monotonic()
+        if settings.xp_cooldown > 0 and not self.cooldowns.hit(
+                message.guild.id, message.author.id, now, settings.xp_cooldown, settings.xp_burst):
+            self.queue_metrics['cooldown_skips'] += 1
+            return
+
+        # Only record the message here; xp_consumer does the XP math and announcements off the gateway path
+        record = (str(message.guild.id), message.author.id, message.channel.id, now)
+        try:
+            self.xp_queue.put_nowait(record)
+        except asyncio.QueueFull:
+            self.queue_metrics['full_waits'] += 1
+            await self.xp_queue.put(record)
+
+    async def next_xp_batch(self):
+        """Wait for queued messages and take up to xp_batch_size of them."""
+        batch = [await self.xp_queue.get()]
+        limit = get_settings().xp_batch_size
+        while len(batch) < limit and not self.xp_queue.empty():
+            batch.append(self.xp_queue.get_nowait())
+        return batch
+
+    async def apply_xp_batch(self, batch):
+        """Award the XP of a batch of queued messages; returns the level-ups as (guild_id, user_id, channel_id, level)."""
+        # Several messages from the same user become one award
+        awards = {}  # (Guild ID, User ID) -> [message count, channel of their latest message]
+        for guild_id, user_id, channel_id, queued_at in batch:
+            award = awards.get((guild_id, user_id))
+            if award is None:
+                awards[(guild_id, user_id)] = [1, channel_id]
+            else:
+                award[0] += 1
+                award[1] = channel_id
+
+        xp_per_message = get_settings().xp_per_message
+        level_ups = []
+        for (guild_id, user_id), (count, channel_id) in awards.items():
+            level, leveled_up = await self.award_xp(guild_id, user_id, count * xp_per_message)
+            if leveled_up:
+                level_ups.append((guild_id, user_id, channel_id, level))
+        return level_ups
+
+    async def announce_level_up(self, guild_id, user_id, channel_id, level):
+        guild = self.bot.get_guild(int(guild_id))
+        member = guild and guild.get_member(user_id)
+        channel = self.bot.get_channel(channel_id)
+        if member is None or channel is None:
+            return
+
+        # Create an embed for the level-up message
+        embed = discord.Embed(
+            title="Level Up!",
+            description=f"Congratulations {member.mention}, you've leveled up to level {level}!",
+            color=discord.Color.green()
+        )
+        embed.set_thumbnail(url=member.display_avatar.url)  # User's profile picture
+        embed.set_footer(text=f"Keep being active, {member.name}, to reach the next level!")  # User's name in footer
+
+        await channel.send(embed=embed)
+
+    @tasks.loop()
+    async def xp_consumer(self):
+        batch = await self.next_xp_batch()
+        try:
+            level_ups = await self.apply_xp_batch(batch)
+        except Exception as e:
+            print(f"Error processing queued XP: {e}")
+            level_ups = []
+        finally:
+            for _ in batch:
+                self.xp_queue.task_done()
+
+        # Latency counts from the oldest message in the batch being queued to its XP being applied
+        metrics = self.queue_metrics
+        latency = time.monotonic() - min(record[3] for record in batch)
+        metrics['batches'] += 1
+        metrics['messages'] += len(batch)
+        metrics['last_latency'] = latency
+        metrics['max_latency'] = max(metrics['max_latency'], latency)
+        metrics['avg_latency'] += (latency - metrics['avg_latency']) * 0.1
+        metrics['max_depth'] = max(metrics['max_depth'], self.xp_queue.qsize() + len(batch))
+
+        # Announcements go out only after the whole batch is applied, so a slow send holds up no XP
+        for level_up in level_ups:
+            try:
+                await self.announce_level_up(*level_up)
+            except discord.HTTPException as e:
+                print(f"Error announcing level up: {e}")
+
+        # The awards are buffered; flush_xp_loop writes them behind, or sooner once enough users are dirty
+        if self.pending_count >= get_settings().xp_flush_threshold and not self.flush_lock.locked():
+            await self.flush_xp()
+
+    async def drain_xp_queue(self, timeout=10.0):
+        """Wait for the consumer to apply every queued message, end open voice sessions, then write the buffered XP."""
+        if self.xp_consumer.is_running():
+            try:
+                await asyncio.wait_for(self.xp_queue.join(), timeout)
+            except asyncio.TimeoutError:
+                print(f"Gave up waiting for {self.xp_queue.qsize()} queued XP messages")
+        if self.voice_live:
+            self.close_voice_sessions()
+            self.voice_live = False
+        await self.settle_voice()
+        await self.flush_xp()
+        await self.save_guild_tops()
+
+    async def save_guild_tops(self):
+        """Write the guild tops if they changed since the last write."""
+        if not self.guild_tops.dirty:
+            return
+        text = self.guild_tops.encode()
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, GuildTops.save, text, self.tops_file)
+        except Exception as e:
+            self.guild_tops.dirty = True
+            print(f"Error writing guild tops: {e}")
+
+    @staticmethod
+    def earns_voice_xp(state):
+        """Whether a voice state counts toward voice XP: connected, outside the AFK channel, and not muted or deafened."""
+        channel = state.channel
+        if channel is None or channel == channel.guild.afk_channel:
+            return False
+        return not (state.self_mute or state.self_deaf or state.mute or state.deaf)
+
+    def add_voice_time(self, guild_id, user_id, seconds):
+        key = (guild_id, user_id)
+        self.voice_seconds[key] = self.voice_seconds.get(key, 0.0) + seconds
+
+    @commands.Cog.listener()
+    async def on_voice_state_update(self, member, before, after):
+        if member.bot:
             return
+        earning_before = self.earns_voice_xp(before)
+        earning_after = self.earns_voice_xp(after)
+        # Moving between channels or toggling video changes nothing unless earning starts or stops
+        if earning_before == earning_after:
+            return
+
+        guild_id = str(member.guild.id)
+        now = time.time()
+        if earning_after:
+            sessions = self.voice_sessions.get(guild_id)
+            if sessions is None:
+                sessions = self.voice_sessions[guild_id] = VoiceSessions()
+            sessions.start(member.id, now)
+        else:
+            sessions = self.voice_sessions.get(guild_id)
+            seconds = sessions and sessions.stop(member.id, now)
+            # Events replayed on a resume are late, so the time since the disconnect isn't credited
+            if seconds and self.voice_live:
+                self.add_voice_time(guild_id, member.id, seconds)
+            if sessions is not None and not sessions:
+                del self.voice_sessions[guild_id]
+        # One checkpoint update per session that starts or stops, never for members just sitting in voice
+        self.save_voice_sessions(guild_id)
+
+    async def settle_voice(self):
+        """Turn the time of ended voice sessions into XP in one batch, carrying partial minutes over to the next settle."""
+        rate = get_settings().xp_per_voice_minute
+        if not self.voice_seconds or rate <= 0:
+            self.voice_seconds.clear()
+            return
+        pending, self.voice_seconds = self.voice_seconds, {}
+        for (guild_id, user_id), seconds in pending.items():
+            xp = int(seconds * rate // 60)
+            if xp:
+                await self.award_xp(guild_id, user_id, xp)
+            remainder = seconds - xp * 60 / rate
+            if remainder > 0:
+                self.add_voice_time(guild_id, user_id, remainder)
+
+    @commands.slash_command()
+    @commands.has_role("STAFF")
+    async def xp_metrics(self, ctx: discord.ApplicationContext):
+        """Show how far behind XP processing is."""
+        metrics = self.queue_metrics
+        await ctx.respond(
+            f"Queue depth: {self.xp_queue.qsize()}/{self.xp_queue.maxsize} (max {metrics['max_depth']}, "
+            f"{metrics['full_waits']} waits on a full queue)\n"
+            f"Batches: {metrics['batches']} covering {metrics['messages']} messages\n"
+            f"Batch latency: {metrics['last_latency'] * 1000:.1f} ms last, {metrics['avg_latency'] * 1000:.1f} ms average, "
+            f"{metrics['max_latency'] * 1000:.1f} ms max\n"
+            f"Messages skipped by the cooldown: {metrics['cooldown_skips']} ({len(self.cooldowns)} users cooling down)\n"
+            f"Users with unwritten XP: {self.pending_count}")
+
+    async def archive_users(self, guild_id, user_ids):
+        """Move users' level entries to the cold archive; returns (users, resident bytes, snapshot bytes) reclaimed."""
+        guild_levels = await self.storage.guild_levels(guild_id)
+        removed = guild_levels.remove_many(user_ids)
+        if not removed:
+            return 0, 0, 0
 
-        guild_id = str(message.guild.id)
-        user_id = str(message.author.id)
+        index = self.leaderboards.get(guild_id)
+        resident = 0
+        for user_id, level, total_xp, last_award in removed:
+            # 20 bytes of columns, plus the user's leaderboard entry if the index is built
+            resident += 20
+            if index is not None:
+                resident += sys.getsizeof((-total_xp, user_id)) + sys.getsizeof(total_xp) + sys.getsizeof(user_id)
+                index.update(user_id, total_xp, None)
+        self.global_leaderboard.invalidate()
 
-        # Initialize the guild data if it doesn't exist
-        if guild_id not in levels_data:
-            levels_data[guild_id] = {}
+        # The removal reaches the disk before the archive adds the XP, so a crash in between can't
+        # leave the entries live to be archived, and counted, a second time
+        keys = [('levels', guild_id, user_id) for user_id, level, total_xp, last_award in removed]
+        self.storage.save(*keys)
+        loop = asyncio.get_running_loop()
+        try:
+            await self.storage.flush()
+            await loop.run_in_executor(None, self.archive.store, guild_id,
+                                       [(user_id, total_xp) for user_id, level, total_xp, last_award in removed])
+        except Exception:
+            # Put the entries back rather than lose them
+            for user_id, level, total_xp, last_award in removed:
+                guild_levels.set(user_id, level, total_xp, last_award)
+                if index is not None:
+                    index.update(user_id, None, total_xp)
+            self.storage.save(*keys)
+            raise
+        for user_id, level, total_xp, last_award in removed:
+            self.guild_tops.remove(guild_id, user_id)
+        if index is not None:
+            # Refill the top with the users below the ones who left
+            self.guild_tops.refresh(guild_id, index)
 
-        # Initialize user data if it doesn't exist
-        if user_id not in levels_data[guild_id]:
-            levels_data[guild_id][user_id] = {"level": 1, "xp": 0}
+        # Size of the removed entries in the configured snapshot format
+        archived = LevelTable()
+        for user_id, level, total_xp, last_award in removed:
+            archived.set(user_id, level, total_xp, last_award)
+        if get_settings().get('levels_snapshot_format', 'json') == 'binary':
+            snapshot = len(archived.to_bytes())
+        else:
+            snapshot = len(json.dumps(archived.to_json(), indent=4))
+        return len(removed), resident, snapshot
+
+    async def restore_users(self, guild_id, user_ids=None):
+        """Bring archived users back (every archived user of the guild when user_ids is None); returns how many."""
+        loop = asyncio.get_running_loop()
+        archived = await loop.run_in_executor(None, self.archive.take, guild_id, user_ids)
+        if not archived:
+            return 0
+        guild_levels = await self.storage.guild_levels(guild_id)
+        index = self.leaderboards.get(guild_id)
+        now = int(time.time())
+        for user_id, archived_xp in archived.items():
+            # XP earned since coming back is added on top of the archived total
+            old = guild_levels.get(user_id)
+            total_xp = archived_xp + (old[1] if old else 0)
+            # Coming back counts as activity, so the inactivity clock starts over
+            guild_levels.set(user_id, level_for_xp(total_xp), total_xp, now)
+            if index is not None:
+                index.update(user_id, old and old[1], total_xp)
+            self.global_leaderboard.award(total_xp)
+            self.guild_tops.update(guild_id, user_id, total_xp)
+        self.storage.save(*[('levels', guild_id, user_id) for user_id in archived])
+        return len(archived)
+
+    async def run_retention(self):
+        """Archive members who left or earned nothing for level_inactive_days and guilds the bot left,
+        and restore archived members who earned XP again before being restored."""
+        report = {'archived': 0, 'restored': 0, 'guilds_left': 0, 'resident': 0, 'snapshot': 0}
+        inactive_days = get_settings().level_inactive_days
+        # Unix time before which a member's last award makes them inactive; 0 matches nobody
+        inactive_before = int(time.time() - inactive_days * 86400) if inactive_days > 0 else 0
+        guilds = {str(guild.id): guild for guild in self.bot.guilds}
+        guild_ids = set(self.storage.levels)
+        if self.storage.backend.lazy:
+            # Partitions not in memory are read for the pass and evicted again later
+            guild_ids |= guilds.keys()
+        loop = asyncio.get_running_loop()
+        for guild_id in guild_ids:
+            guild = guilds.get(guild_id)
+            if guild is None:
+                departed = list((await self.storage.guild_levels(guild_id)).ids)
+                if not departed:
+                    continue
+                report['guilds_left'] += 1
+                self.leaderboards.pop(guild_id, None)
+            else:
+                guild_levels = await self.storage.guild_levels(guild_id)
+                departed = set(guild_levels.inactive(inactive_before))
+                # Without the full member list everyone would look departed
+                if guild.chunked:
+                    departed.update(user_id for user_id in guild_levels.ids if guild.get_member(user_id) is None)
+                    # Inactive members stay archived while they're quiet; one with a live entry again
+                    # (e.g. who rejoined and chatted while the bot was offline) gets the archive back
+                    returned = [user_id for user_id in await loop.run_in_executor(None, self.archive.user_ids, guild_id)
+                                if user_id in guild_levels and guild.get_member(user_id) is not None]
+                    if returned:
+                        report['restored'] += await self.restore_users(guild_id, returned)
+                if not departed:
+                    continue
+                departed = list(departed)
+            archived, resident, snapshot = await self.archive_users(guild_id, departed)
+            report['archived'] += archived
+            report['resident'] += resident
+            report['snapshot'] += snapshot
+        return report
+
+    @staticmethod
+    def format_retention(report):
+        return (f"Archived {report['archived']} level entries ({report['guilds_left']} servers left), "
+                f"restored {report['restored']}; reclaimed {report['resident'] / 1024:.1f} KiB of memory "
+                f"and {report['snapshot'] / 1024:.1f} KiB of level snapshot.")
 
-        # Award XP for sending a message
-        xp_per_message = get_setting('xp_per_message', 10)
-        levels_data[guild_id][user_id]["xp"] += xp_per_message
+    @tasks.loop(hours=24)
+    async def retention_loop(self):
+        try:
+            report = await self.run_retention()
+        except Exception as e:
+            print(f"Error archiving level data: {e}")
+            return
+        if report['archived'] or report['restored']:
+            print(self.format_retention(report))
+        hours = get_settings().retention_interval_hours
+        if hours != self.retention_loop.hours:
+            self.retention_loop.change_interval(hours=hours)
 
-        # Check for level up
-        current_level = levels_data[guild_id][user_id]["level"]
-        if levels_data[guild_id][user_id]["xp"] >= xp_needed(current_level):
-            levels_data[guild_id][user_id]["level"] += 1
-            levels_data[guild_id][user_id]["xp"] = 0  # Reset XP or adjust as needed
-            
-            # Create an embed for the level-up message
-            embed = discord.Embed(
-                title="Level Up!",
-                description=f"Congratulations {message.author.mention}, you've leveled up to level {levels_data[guild_id][user_id]['level']}!",
-                color=discord.Color.green()
-            )
-            embed.set_thumbnail(url=message.author.avatar.url)  # User's profile picture
-            embed.set_footer(text=f"Keep being active, {message.author.name}, to reach the next level!")  # User's name in footer
+    @retention_loop.before_loop
+    async def before_retention_loop(self):
+        await self.bot.wait_until_ready()
 
-            await message.channel.send(embed=embed)
+    @commands.Cog.listener()
+    async def on_member_join(self, member):
+        if not member.bot:
+            await self.restore_users(str(member.guild.id), [member.id])
 
-        # Save levels data after each message
-        save_levels(levels_data)
+    @commands.Cog.listener()
+    async def on_guild_join(self, guild):
+        await self.restore_users(str(guild.id))
+
+    @commands.slash_command()
+    async def prune_levels(self, ctx: discord.ApplicationContext):
+        """Archive the level data of members and servers that are gone or inactive, right now (bot owner only)."""
+        if ctx.author.id != get_settings().owner_id:
+            await ctx.respond("Only the bot owner can prune level data.", ephemeral=True)
+            return
+        await ctx.defer()
+        await ctx.respond(self.format_retention(await self.run_retention()))
 
     @commands.slash_command()
     async def level(self, ctx: discord.ApplicationContext):
         """Check your current level and XP."""
         guild_id = str(ctx.guild.id)  # Get the server (guild) ID
-        user_id = str(ctx.author.id)
+        guild_levels = await self.storage.guild_levels(guild_id)
+        entry = guild_levels.get(ctx.author.id)
 
-        if guild_id in levels_data and user_id in levels_data[guild_id]:
-            level = levels_data[guild_id][user_id]["level"]
-            xp = levels_data[guild_id][user_id]["xp"]
-            await ctx.respond(f"{ctx.author.mention}, you are currently level {level} with {xp} XP.")
+        if entry:
+            level, total_xp = entry
+            xp = total_xp - xp_for_level(level)
+            await ctx.respond(f"{ctx.author.mention}, you are currently level {level} with {xp}/{xp_needed(level)} XP ({total_xp} total).")
         else:
             await ctx.respond(f"{ctx.author.mention}, you have not gained any XP yet.")
 
+    async def global_leaderboard_rows(self):
+        """Top users across every guild as (user_id, guild_id, rank, total_xp), merged from the guild tops at most once per TTL."""
+        now = time.monotonic()
+        rows = self.global_leaderboard.get(now)
+        if rows is None:
+            # Built indexes are exact, so their tops are refreshed from them; partitions that aren't
+            # in memory are represented by their saved tops and only read if they have none yet
+            for guild_id, index in list(self.leaderboards.items()):
+                self.guild_tops.refresh(guild_id, index)
+            for guild_id in (set(self.storage.levels) | {str(guild.id) for guild in self.bot.guilds}) - self.guild_tops.tops.keys():
+                self.guild_tops.refresh(guild_id, await self.leaderboard_index(guild_id))
+            rows = []
+            for position, (user_id, guild_id, total_xp) in enumerate(merge_top(self.guild_tops.tops, self.global_leaderboard.size)):
+                # Users with the same total share the rank of the first of them
+                rank = rows[-1][2] if rows and rows[-1][3] == total_xp else position + 1
+                rows.append((user_id, guild_id, rank, total_xp))
+            self.global_leaderboard.store(rows, now)
+        return rows
+
+    async def leaderboard_page(self, guild, scope, page, page_size=10):
+        """Embed for one leaderboard page; returns (embed, page shown, total pages), or (None, 0, 0) if nobody has XP."""
+        if scope == "global":
+            rows = await self.global_leaderboard_rows()
+            total = len(rows)
+            title = "Global Leaderboard"
+
+            def page_rows(page):
+                for user_id, guild_id, rank, total_xp in rows[page * page_size:(page + 1) * page_size]:
+                    user = self.bot.get_user(user_id)
+                    user_guild = self.bot.get_guild(int(guild_id))
+                    username = user.display_name if user else "Unknown User"
+                    yield rank, f"{username} ({user_guild.name if user_guild else 'Unknown Server'})", total_xp
+        else:
+            guild_id = str(guild.id)  # Get the server (guild) ID
+            index = await self.leaderboard_index(guild_id)
+            total = len(index)
+            title = "Leaderboard"
+
+            def page_rows(page):
+                # Only this page's entries are read from the index
+                for user_id, rank, total_xp in index.page(page * page_size, page_size):
+                    user = guild.get_member(user_id)
+                    yield rank, user.display_name if user else "Unknown User", total_xp
+
+        if not total:
+            return None, 0, 0
+
+        # Pagination logic
+        total_pages = (total + page_size - 1) // page_size  # Calculate total pages
+        page = min(max(page, 0), total_pages - 1)
+
+        embed = discord.Embed(title=title, color=discord.Color.blue())
+        for rank, username, total_xp in page_rows(page):
+            embed.add_field(name=f"{rank}. {username}", value=f"Level: {level_for_xp(total_xp)}, XP: {total_xp}", inline=False)
+        embed.set_footer(text=f"Page {page + 1}/{total_pages}")
+        return embed, page, total_pages
+
+    def leaderboard_view(self, scope, page, total_pages, user_id):
+        """Previous/next buttons whose custom_ids carry the page they lead to."""
+        view = discord.ui.View(timeout=None, store=False)
+        for emoji, target in (("◀️", page - 1), ("▶️", page + 1)):
+            view.add_item(discord.ui.Button(
+                emoji=emoji, style=discord.ButtonStyle.secondary, disabled=not 0 <= target < total_pages,
+                custom_id=self.bot.router.custom_id('lb', scope, target, user_id, timeout=LEADERBOARD_PROMPT_SECONDS)))
+        return view
+
     @commands.slash_command()
-    async def leaderboard(self, ctx: discord.ApplicationContext):
+    async def leaderboard(self, ctx: discord.ApplicationContext, page: int = 1,
+                          scope: discord.Option(str, "Rank this server or every server the bot is in",
+                                                choices=["server", "global"], default="server") = "server"):
         """Display the leaderboard of users by level with pagination."""
-        guild_id = str(ctx.guild.id)  # Get the server (guild) ID
- 
-        if guild_id not in levels_data or not levels_data[guild_id]:
+        await ctx.defer()
+        embed, page, total_pages = await self.leaderboard_page(ctx.guild, scope, page - 1)
+        if embed is None:
             await ctx.respond("No users have gained levels yet.")
             return
- 
-        # Create a list of users and their levels
-        leaderboard = []
-        for user_id, data in levels_data[guild_id].items():
-            leaderboard.append((user_id, data["level"], data["xp"]))
- 
-        # Sort the leaderboard by level and XP
-        leaderboard.sort(key=lambda x: (x[1], x[2]), reverse=True)
-
-        # Assign ranks
-        ranked_leaderboard = []
-        current_rank = 1
-        previous_level = None
-        previous_xp = None
-
-        for index, (user_id, level, xp) in enumerate(leaderboard):
-            if (level, xp) != (previous_level, previous_xp):
-                current_rank = index + 1  # Update rank only if the level and XP change
-            ranked_leaderboard.append((user_id, current_rank, level, xp))  # Store user_id, rank, level, and XP
-            previous_level, previous_xp = level, xp  # Update previous_level and previous_xp for the next iteration
 
-        # Pagination logic
-        page_size = 10
-        total_pages = (len(ranked_leaderboard) + page_size - 1) // page_size  # Calculate total pages
-        current_page = 0
- 
-        # Function to create and send the embed for the current page
-        async def send_leaderboard_page(page):
-            embed = discord.Embed(title="Leaderboard", color=discord.Color.blue())
-            start_index = page * page_size
-            end_index = start_index + page_size
-            for index, (user_id, rank, level, xp) in enumerate(ranked_leaderboard[start_index:end_index], start=start_index + 1):
-                user = ctx.guild.get_member(int(user_id))
-                username = user.display_name if user else "Unknown User"
-                embed.add_field(name=f"{rank}. {username}", value=f"Level: {level}, XP: {xp}", inline=False)
-            embed.set_footer(text=f"Page {page + 1}/{total_pages}")
-            return embed
- 
-        # Send the initial message with the leaderboard
-        message = await ctx.respond("Here is the leaderboard:", embed=await send_leaderboard_page(current_page))
-        message = await message.original_message()
-
-        # Add reactions for pagination
-        if total_pages > 1:
-            await message.add_reaction("◀️")  # Previous page
-            await message.add_reaction("▶️")  # Next page
-
-        # Reaction handling
-        async def check(reaction, user):
-            return user == ctx.author and str(reaction.emoji) in ["◀️", "▶️"] and reaction.message.id == message.id
-
-        while True:
-            try:
-                reaction, user = await self.bot.wait_for("reaction_add", timeout=60.0, check=check)
-                if str(reaction.emoji) == "◀️" and current_page > 0:
-                    current_page -= 1
-                    await message.edit(embed=await send_leaderboard_page(current_page))
-                elif str(reaction.emoji) == "▶️" and current_page < total_pages - 1:
-                    current_page += 1
-                    await message.edit(embed=await send_leaderboard_page(current_page))
+        # Paging buttons are handled by on_leaderboard_page through the component router
+        view = self.leaderboard_view(scope, page, total_pages, ctx.author.id) if total_pages > 1 else None
+        await ctx.respond("Here is the leaderboard:", embed=embed, view=view)
+
+    async def on_leaderboard_page(self, interaction, scope, page, user_id):
+        if interaction.user.id != int(user_id):
+            await interaction.response.send_message("Only the person who opened this leaderboard can turn its pages.", ephemeral=True)
+            return
+        # Building the page can read guild partitions, which may outlast the 3 second response deadline
+        await interaction.response.defer()
+        embed, page, total_pages = await self.leaderboard_page(interaction.guild, scope, int(page))
+        if embed is None:
+            await interaction.edit_original_response(content="No users have gained levels yet.", embed=None, view=None)
+            return
+        await interaction.edit_original_response(embed=embed, view=self.leaderboard_view(scope, page, total_pages, user_id))
+
+    @commands.slash_command()
+    async def rank(self, ctx: discord.ApplicationContext, member: discord.Member = None):
+        """Show your (or another member's) position on the leaderboard."""
+        member = member or ctx.author
+        guild_id = str(ctx.guild.id)
+        index = await self.leaderboard_index(guild_id)
+        entry = (await self.storage.guild_levels(guild_id)).get(member.id)
+
+        if not entry:
+            await ctx.respond(f"{member.display_name} has not gained any XP yet.")
+            return
+
+        level, total_xp = entry
+        await ctx.respond(f"{member.display_name} is ranked #{index.rank(total_xp)} of {len(index)} at level {level} with {total_xp} XP.")
 
-                # Remove the user's reaction
-                await message.remove_reaction(reaction, user)
+    @commands.slash_command()
+    @commands.has_role("STAFF")
+    async def recompute_levels(self, ctx: discord.ApplicationContext):
+        """Recalculate every level in this server from total XP after the level curve changes."""
+        guild_id = str(ctx.guild.id)
+        guild_levels = await self.storage.guild_levels(guild_id)
 
-            except Exception as e:
-                print(f"Error during reaction handling: {e}")
-                break  # Exit the loop on timeout or error
+        changed = guild_levels.recompute_levels(get_settings().xp_level_step)
+        # Ranking is by total XP alone, so the leaderboard index is unaffected
+        self.storage.save(*[('levels', guild_id, user_id) for user_id in changed])
+        await ctx.respond(f"Recalculated levels for {len(guild_levels)} members; {len(changed)} changed level.")
 
     @commands.slash_command()
     @commands.has_role("STAFF")
-    async def retroactive_roles(self, ctx: discord.ApplicationContext):
-        """Retroactively assign roles to users who meet the level requirements."""
+    async def retroactive_roles(self, ctx: discord.ApplicationContext, restart: bool = False):
+        """Bring every member's level roles in line with their level, resuming an interrupted run."""
         guild_id = str(ctx.guild.id)
-        level_roles = get_setting('level_roles', {})
-        
-        if not level_roles:
+        guild_levels = await self.storage.guild_levels(guild_id)
+        settings = get_settings()
+
+        if not settings.level_roles:
             await ctx.respond("No level roles configured.")
             return
-            
-        if guild_id not in levels_data:
+
+        if not guild_levels:
             await ctx.respond("No level data exists for this server.")
             return
-            
-        assigned_count = 0
-        for role_key, role_config in level_roles.items():
-            role_name = role_config.get('name', '')
-            required_level = role_config.get('required_level', 0)
-            
-            role = discord.utils.get(ctx.guild.roles, name=role_name)
-            if not role:
-                await ctx.respond(f"Error: The role '{role_name}' does not exist.")
-                continue
-                
-            for user_id, data in levels_data[guild_id].items():
-                if data["level"] >= required_level:
-                    member = ctx.guild.get_member(int(user_id))
-                    if member and role not in member.roles:
-                        await member.add_roles(role)
-                        assigned_count += 1
-                    
-        await ctx.respond(f"Successfully assigned roles to {assigned_count} members based on their levels.")
\ No newline at end of file
+
+        if guild_id in self.role_syncs:
+            await ctx.respond("Level roles are already being updated in this server.")
+            return
+
+        level_roles = LevelRoles(ctx.guild, settings.level_roles)
+        if not level_roles:
+            await ctx.respond(f"Error: None of the level roles exist ({', '.join(level_roles.missing)}).")
+            return
+        if restart:
+            self.checkpoints.clear(RoleSync.JOB, ctx.guild.id)
+
+        sync = RoleSync(ctx.guild, level_roles, self.checkpoints, concurrency=settings.role_sync_concurrency)
+        self.role_syncs[guild_id] = sync
+        notes = ""
+        if level_roles.missing:
+            notes += f" Skipping missing roles: {', '.join(level_roles.missing)}."
+        if sync.resumed:
+            notes += " Resuming the previous run."
+
+        # Progress goes to one channel message, since interaction responses stop being editable after 15 minutes
+        await ctx.respond(f"Updating level roles.{notes}")
+        progress = await ctx.channel.send("Level roles: starting...")
+
+        async def report(text):
+            try:
+                await progress.edit(content=f"Level roles: {text}")
+            except discord.HTTPException as e:
+                print(f"Error updating role progress: {e}")
+
+        try:
+            await sync.run(guild_levels, report)
+        finally:
+            del self.role_syncs[guild_id]
+        await report(f"done. {sync.progress()}.")
+
+    @commands.slash_command()
+    async def backfill_xp(self, ctx: discord.ApplicationContext, restart: bool = False):
+        """Award XP for the messages sent in this server before the bot joined (bot owner only)."""
+        settings = get_settings()
+        if ctx.author.id != settings.owner_id:
+            await ctx.respond("Only the bot owner can backfill XP.", ephemeral=True)
+            return
+
+        guild_id = str(ctx.guild.id)
+        if guild_id in self.backfills:
+            await ctx.respond("XP is already being backfilled in this server.")
+            return
+        if restart:
+            self.checkpoints.clear(XpBackfill.JOB, ctx.guild.id)
+
+        # Messages since the bot joined already earned XP through on_message
+        backfill = XpBackfill(ctx.guild, functools.partial(self.award_xp, active=False), self.flush_xp, self.checkpoints, ctx.guild.me.joined_at,
+                              settings.xp_per_message, settings.xp_cooldown, settings.xp_burst,
+                              concurrency=settings.backfill_concurrency)
+        if backfill.resumed and not backfill.channels():
+            await ctx.respond("This server's history has already been backfilled; use restart to award it again.")
+            return
+
+        self.backfills[guild_id] = backfill
+        await ctx.respond("Backfilling XP from message history." + (" Resuming the previous run." if backfill.resumed else ""))
+        progress = await ctx.channel.send("XP backfill: starting...")
+
+        async def report(text):
+            try:
+                await progress.edit(content=f"XP backfill: {text}")
+            except discord.HTTPException as e:
+                print(f"Error updating backfill progress: {e}")
+
+        try:
+            await backfill.run(report)
+        finally:
+            del self.backfills[guild_id]
+        failed = f" Could not read: {', '.join(backfill.failed)}; run again to retry." if backfill.failed else ""
+        await report(f"done. {backfill.progress()}.{failed}")
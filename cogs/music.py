@@ -5,6 +5,25 @@ import asyncio
 from collections import deque
 import imageio_ffmpeg
 
+# Seconds the search results of /play can be picked from
+SEARCH_PROMPT_SECONDS = 60
+
+# Configure yt-dlp options (extract bestaudio URL, do not download)
+YDL_OPTS = {
+    'format': 'bestaudio/best',
+    'noplaylist': True,
+    'quiet': True,
+    'no_warnings': True,
+    'default_search': 'ytsearch',
+    'socket_timeout': 10,
+    'extract_flat': False,
+}
+
+def extract_info(query):
+    """yt-dlp info for a URL, video ID or "ytsearchN:" query; blocks, so run it in an executor."""
+    with yt_dlp.YoutubeDL(YDL_OPTS) as ydl:
+        return ydl.extract_info(query, download=False)
+
 class Music(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
@@ -14,6 +33,7 @@ class Music(commands.Cog):
         self.song_owners = {}  # Server ID -> User ID of who added the song
         self.music_channels = {}  # Server ID -> Channel ID for music messages
         self.volumes = {}  # Server ID -> 0.0-2.0
+        bot.router.add('music', self.on_music_pick)
 
     def get_queue(self, guild_id):
         if guild_id not in self.queues:
@@ -24,6 +44,32 @@ class Music(commands.Cog):
         """Check if a member has the DJ role"""
         return any(role.name.lower() == 'dj' for role in member.roles)
 
+    async def connect(self, guild, member):
+        """Join the member's voice channel unless already connected; returns an error embed on failure."""
+        try:
+            if guild.id not in self.voice_clients or not self.voice_clients[guild.id].is_connected():
+                self.voice_clients[guild.id] = await member.voice.channel.connect()
+        except Exception as e:
+            return discord.Embed(title="Error", description=f"Failed to connect to voice channel: {str(e)}", color=discord.Color.red())
+        return None
+
+    async def enqueue(self, guild, user_id, title, url, message):
+        """Add a song to the guild's queue, report it on message and start playback if the queue was empty."""
+        queue = self.get_queue(guild.id)
+        queue.append((title, url))
+        # Store who added the song
+        if guild.id not in self.song_owners:
+            self.song_owners[guild.id] = []
+        self.song_owners[guild.id].append(user_id)
+
+        if len(queue) == 1:  # If this is the first song
+            embed = discord.Embed(title="Added to Queue", description=f"Added {title} and starting playback!", color=discord.Color.green())
+            await message.edit(embed=embed, view=None)
+            await self.play_next(guild)
+        else:
+            embed = discord.Embed(title="Added to Queue", description=title, color=discord.Color.green())
+            await message.edit(embed=embed, view=None)
+
     @commands.slash_command()
     async def play(self, ctx, query: str):
         """Play from URL (YouTube, SoundCloud, MP3, etc.) or search query"""
@@ -41,50 +87,22 @@ class Music(commands.Cog):
         self.music_channels[ctx.guild.id] = ctx.channel.id
 
         # Get or create voice client (this can take time, so we respond first)
-        try:
-            if ctx.guild.id not in self.voice_clients:
-                self.voice_clients[ctx.guild.id] = await ctx.author.voice.channel.connect()
-            elif not self.voice_clients[ctx.guild.id].is_connected():
-                self.voice_clients[ctx.guild.id] = await ctx.author.voice.channel.connect()
-        except Exception as e:
-            error_embed = discord.Embed(title="Error", description=f"Failed to connect to voice channel: {str(e)}", color=discord.Color.red())
+        error_embed = await self.connect(ctx.guild, ctx.author)
+        if error_embed:
             await message.edit(embed=error_embed)
             return
 
         # Detect direct URL vs search
         is_url = query.lower().startswith('http://') or query.lower().startswith('https://')
 
-        # Configure yt-dlp options (extract bestaudio URL, do not download)
-        ydl_opts = {
-            'format': 'bestaudio/best',
-            'noplaylist': True,
-            'quiet': True,
-            'no_warnings': True,
-            'default_search': 'ytsearch',
-            'socket_timeout': 10,
-            'extract_flat': False,
-        }
-
         try:
             # Run yt-dlp operations in executor to avoid blocking
             loop = asyncio.get_event_loop()
-            
-            def extract_url_info(url):
-                with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                    return ydl.extract_info(url, download=False)
-            
-            def extract_search_info(search_query):
-                with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                    return ydl.extract_info(f"ytsearch5:{search_query}", download=False)
-            
-            def extract_video_info(video_id):
-                with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                    return ydl.extract_info(video_id, download=False)
-            
+
             if is_url:
                 # Update message to show we're processing
                 await message.edit(embed=discord.Embed(title="Processing", description=f"Extracting audio from URL...", color=discord.Color.blue()))
-                info = await asyncio.wait_for(loop.run_in_executor(None, extract_url_info, query), timeout=30.0)
+                info = await asyncio.wait_for(loop.run_in_executor(None, extract_info, query), timeout=30.0)
                 # Handle playlists by taking first entry
                 if info.get('_type') == 'playlist' and info.get('entries'):
                     info = info['entries'][0]
@@ -93,25 +111,12 @@ class Music(commands.Cog):
                 if not url2:
                     raise Exception('Unable to extract audio URL for this link.')
 
-                # Add to queue
-                queue = self.get_queue(ctx.guild.id)
-                queue.append((title, url2))
-                if ctx.guild.id not in self.song_owners:
-                    self.song_owners[ctx.guild.id] = []
-                self.song_owners[ctx.guild.id].append(ctx.author.id)
-
-                if len(queue) == 1:
-                    embed = discord.Embed(title="Added to Queue", description=f"Added {title} and starting playback!", color=discord.Color.green())
-                    await message.edit(embed=embed)
-                    await self.play_next(ctx.guild)
-                else:
-                    embed = discord.Embed(title="Added to Queue", description=title, color=discord.Color.green())
-                    await message.edit(embed=embed)
+                await self.enqueue(ctx.guild, ctx.author.id, title, url2, message)
                 return
 
             # Otherwise perform YouTube search results flow
             await message.edit(embed=discord.Embed(title="Searching", description=f"Searching YouTube for: {query}...", color=discord.Color.blue()))
-            search_info = await asyncio.wait_for(loop.run_in_executor(None, extract_search_info, query), timeout=30.0)
+            search_info = await asyncio.wait_for(loop.run_in_executor(None, extract_info, f"ytsearch5:{query}"), timeout=30.0)
             search_results = search_info.get('entries', [])
             
             if not search_results:
@@ -119,7 +124,7 @@ class Music(commands.Cog):
                 await message.edit(embed=embed)
                 return
 
-            # Create select menu options
+            # Create select menu options; each value is the video ID, so the pick needs no saved results
             options = []
             for i, result in enumerate(search_results, 1):
                 title = result['title']
@@ -129,61 +134,55 @@ class Music(commands.Cog):
                     seconds = duration % 60
                     duration = f"{minutes}:{seconds:02d}"
                 options.append(discord.SelectOption(
-                    label=f"{i}. {title[:100]}",  # Discord has a 100 char limit for labels
-                    value=str(i-1),
+                    label=f"{i}. {title[:96]}",  # Discord has a 100 char limit for labels
+                    value=result['id'],
                     description=f"Duration: {duration}"
                 ))
 
-            # Create select menu
+            # Create select menu; the router sends the pick to on_music_pick
             select = discord.ui.Select(
                 placeholder="Choose a song",
-                options=options
+                options=options,
+                custom_id=self.bot.router.custom_id('music', ctx.author.id, timeout=SEARCH_PROMPT_SECONDS)
             )
 
             # Create view
-            view = discord.ui.View()
-            view.add_item(select)
+            view = discord.ui.View(select, timeout=None, store=False)
 
             # Update message with select menu
             embed = discord.Embed(title="Search Results", description="Please select a song:", color=discord.Color.blue())
             await message.edit(embed=embed, view=view)
 
-            # Wait for selection
-            def check(interaction):
-                return interaction.user == ctx.author and interaction.data['component_type'] == 3
+        except asyncio.TimeoutError:
+            embed = discord.Embed(title="Timeout", description="The operation took too long. Please try again.", color=discord.Color.red())
+            await message.edit(embed=embed, view=None)
+        except Exception as e:
+            embed = discord.Embed(title="Error", description=f"An error occurred: {str(e)}", color=discord.Color.red())
+            await message.edit(embed=embed, view=None)
 
-            try:
-                interaction = await self.bot.wait_for("interaction", check=check, timeout=60.0)
-                selected_index = int(interaction.data['values'][0])
-                selected_video = search_results[selected_index]
-                
-                # Get the video URL
-                await message.edit(embed=discord.Embed(title="Processing", description="Getting audio URL...", color=discord.Color.blue()))
-                info = await asyncio.wait_for(loop.run_in_executor(None, extract_video_info, selected_video['id']), timeout=30.0)
-                title = info['title']
-                url2 = info['url']
-
-                # Add to queue
-                queue = self.get_queue(ctx.guild.id)
-                queue.append((title, url2))
-                # Store who added the song
-                if ctx.guild.id not in self.song_owners:
-                    self.song_owners[ctx.guild.id] = []
-                self.song_owners[ctx.guild.id].append(ctx.author.id)
-
-                if len(queue) == 1:  # If this is the first song
-                    embed = discord.Embed(title="Added to Queue", description=f"Added {title} and starting playback!", color=discord.Color.green())
-                    await message.edit(embed=embed, view=None)
-                    await self.play_next(ctx.guild)
-                else:
-                    embed = discord.Embed(title="Added to Queue", description=title, color=discord.Color.green())
-                    await message.edit(embed=embed, view=None)
-
-            except asyncio.TimeoutError:
-                embed = discord.Embed(title="Timeout", description="You took too long to select a song!", color=discord.Color.red())
-                await message.edit(embed=embed, view=None)
-                return
+    async def on_music_pick(self, interaction, user_id):
+        if interaction.user.id != int(user_id):
+            await interaction.response.send_message("Use /play to pick your own song.", ephemeral=True)
+            return
+        guild = interaction.guild
+        message = interaction.message
+        if not interaction.user.voice:
+            await interaction.response.edit_message(
+                embed=discord.Embed(title="Error", description="You need to be in a voice channel!", color=discord.Color.red()), view=None)
+            return
 
+        # Get the video URL
+        await interaction.response.edit_message(embed=discord.Embed(title="Processing", description="Getting audio URL...", color=discord.Color.blue()), view=None)
+        # The bot may have left or restarted since the search
+        error_embed = await self.connect(guild, interaction.user)
+        if error_embed:
+            await message.edit(embed=error_embed)
+            return
+        self.music_channels[guild.id] = interaction.channel_id
+        try:
+            loop = asyncio.get_event_loop()
+            info = await asyncio.wait_for(loop.run_in_executor(None, extract_info, interaction.data['values'][0]), timeout=30.0)
+            await self.enqueue(guild, interaction.user.id, info['title'], info['url'], message)
         except asyncio.TimeoutError:
             embed = discord.Embed(title="Timeout", description="The operation took too long. Please try again.", color=discord.Color.red())
             await message.edit(embed=embed, view=None)
@@ -350,6 +349,7 @@ class Music(commands.Cog):
             await ctx.respond(embed=embed)
 
     def cog_unload(self):
+        self.bot.router.remove('music')
         # Attempt to gracefully cleanup any active voice clients/sources
         for gid, vc in list(self.voice_clients.items()):
             try:
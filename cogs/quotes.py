@@ -1,33 +1,69 @@
-import discord
-from discord.ext import commands
-import json
-import os
-import random
-
-DB_FILE = 'db.json'
-
-def load_db():
-    if not os.path.exists(DB_FILE):
-        return {"quotes": [], "birthdays": {}, "levels": {}}
-    with open(DB_FILE, 'r', encoding='utf-8') as f:
-        return json.load(f)
+import asyncio
 
-def save_db(data):
-    with open(DB_FILE, 'w', encoding='utf-8') as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+import discord
+from discord import SlashCommandGroup
+from discord.ext import commands, tasks
 
-def load_quotes():
-    data = load_db()
-    return data.get('quotes', [])
+from util.config import get_settings
+from util.quote_import import QuoteImport
+from util.quote_search import INDEX_FILE, QuoteSearchIndex
+from util.quotes import QuoteStore, new_quote, payload_author
 
-def save_quotes(quotes):
-    data = load_db()
-    data['quotes'] = quotes
-    save_db(data)
+# Matches shown per page of /quotes search
+SEARCH_PAGE_SIZE = 5
+# Quotes shown per page of /quotes list
+LIST_PAGE_SIZE = 5
+# Seconds the paging buttons of /quotes list keep working
+LIST_PROMPT_SECONDS = 600
 
 class Quotes(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
+        self.storage = bot.storage
+        # The search index is read from its file and only quotes saved since are tokenized
+        self.index_file = get_settings().get('quote_index_file', INDEX_FILE)
+        self.search_index = QuoteSearchIndex.load(self.index_file)
+        self.search_index.sync(self.storage.quotes)
+        if self.search_index.rewrite:
+            # Folded in before the bot connects, so the whole dump never holds up the event loop
+            try:
+                QuoteSearchIndex.save(self.search_index.encode(), self.index_file)
+            except OSError as e:
+                self.search_index.rewrite = True
+                print(f"Error writing quote search index: {e}")
+        self.index_lock = asyncio.Lock()  # Keeps log appends in order
+        self.store = QuoteStore(self.storage, self.search_index)  # Each guild's quotes, indexed by author
+        self.save_index_loop.start()
+        bot.router.add('ql', self.on_quote_list_page)
+        self.imports = set()  # IDs of the guilds with an import running
+
+    quotes = SlashCommandGroup("quotes", "Saved quote commands")
+
+    def cog_unload(self):
+        self.save_index_loop.cancel()
+        self.bot.router.remove('ql')
+
+    @tasks.loop(seconds=60)
+    async def save_index_loop(self):
+        await self.save_search_index()
+
+    async def save_search_index(self):
+        """Append the quotes indexed since the last write to the search index's log."""
+        async with self.index_lock:
+            index = self.search_index
+            if index.rewrite:
+                # Only after a failed write, when the log can no longer be trusted
+                text, write = index.encode(), QuoteSearchIndex.save
+            elif index.log:
+                text, write = index.take_log(), QuoteSearchIndex.append
+            else:
+                return
+            try:
+                await asyncio.get_running_loop().run_in_executor(None, write, text, self.index_file)
+            except Exception as e:
+                # A partial append may have torn the log, so the next write replaces the whole index
+                index.rewrite = True
+                print(f"Error writing quote search index: {e}")
 
     @commands.slash_command(name='quote', description='Save a quote by replying to a message.')
     async def quote(self, ctx: discord.ApplicationContext):
@@ -37,83 +73,167 @@ class Quotes(commands.Cog):
             await ctx.respond('Please use this command by replying to a message.', ephemeral=True)
             return
 
-        # Get the first replied message (should only be one)
+        # Get the first replied message (should only be one); the resolved payload has
+        # everything the quote needs, so the message isn't fetched again
         message_id, message_payload = next(iter(ref_data.items()))
-        try:
-            quoted_message = await ctx.channel.fetch_message(int(message_id))
-        except discord.NotFound:
-            await ctx.respond('Could not find the referenced message.', ephemeral=True)
+        author_id = int(message_payload['author']['id'])
+        content = message_payload.get('content', '')
+
+        if self.store.has(ctx.guild.id, author_id, content):
+            await ctx.respond('This quote has already been saved!', ephemeral=True)
             return
 
-        quotes = load_quotes()
-        quote_entry = {
-            'content': quoted_message.content,
-            'author': str(quoted_message.author),
-            'author_id': quoted_message.author.id,
-            'saved_by': str(ctx.author),
-            'saved_by_id': ctx.author.id,
-            'channel_id': ctx.channel.id,
-            'guild_id': ctx.guild.id
-        }
-        quotes.append(quote_entry)
-        save_quotes(quotes)
+        quote_entry = new_quote(content, payload_author(message_payload['author']), author_id,
+                                str(ctx.author), ctx.author.id, ctx.channel.id, ctx.guild.id)
+        self.store.add(quote_entry)
         await ctx.respond('Quote saved!', ephemeral=True)
 
-    @commands.slash_command(name='quotes', description='Show a random saved quote.')
-    async def quotes(self, ctx: discord.ApplicationContext, user: discord.Member = None):
+    @quotes.command(name='random', description='Show a random saved quote.')
+    async def random_quote(self, ctx: discord.ApplicationContext, user: discord.Member = None):
         """Show a random quote, optionally filtered by user."""
-        quotes = load_quotes()
-        if not quotes:
+        if not self.store.count(ctx.guild.id):
             await ctx.respond('No quotes saved yet!')
             return
         
         # Filter by user if specified
         if user:
-            user_quotes = [q for q in quotes if q['author_id'] == user.id]
-            if not user_quotes:
+            quote = self.store.random(ctx.guild.id, user.id)
+            if quote is None:
                 await ctx.respond(f'No quotes saved from {user.display_name} yet!')
                 return
-            quote = random.choice(user_quotes)
+            count = self.store.count(ctx.guild.id, user.id)
             embed = discord.Embed(
                 description=quote['content'], 
                 color=discord.Color.purple(),
                 title=f"Quote from {user.display_name}"
             )
             embed.set_author(name=f"{quote['author']}", icon_url=user.avatar.url if user.avatar else user.default_avatar.url)
-            embed.set_footer(text=f"Saved by {quote['saved_by']} • {len(user_quotes)} total quote{'s' if len(user_quotes) != 1 else ''}")
+            embed.set_footer(text=f"Saved by {quote['saved_by']} • {count} total quote{'s' if count != 1 else ''}")
         else:
-            quote = random.choice(quotes)
+            quote = self.store.random(ctx.guild.id)
             embed = discord.Embed(description=quote['content'], color=discord.Color.purple())
             embed.set_author(name=f"{quote['author']}")
             embed.set_footer(text=f"Saved by {quote['saved_by']}")
         
         await ctx.respond(embed=embed)
 
+    @quotes.command(name='search', description='Find saved quotes containing every one of the given words.')
+    async def search_quotes(self, ctx: discord.ApplicationContext, terms: str, page: int = 1):
+        """Search this server's quotes, shortest matches first."""
+        total, positions = self.search_index.search(ctx.guild.id, terms, (max(page, 1) - 1) * SEARCH_PAGE_SIZE, SEARCH_PAGE_SIZE)
+        if not total:
+            await ctx.respond(f'No quotes found for "{terms}".', ephemeral=True)
+            return
+        total_pages = (total + SEARCH_PAGE_SIZE - 1) // SEARCH_PAGE_SIZE
+        if not positions:
+            await ctx.respond(f'There are only {total_pages} page{"s" if total_pages != 1 else ""} of results.', ephemeral=True)
+            return
+
+        embed = discord.Embed(title=f'Quotes matching "{terms}"', color=discord.Color.purple())
+        quotes = self.store.quotes(ctx.guild.id)
+        for position in positions:
+            quote = quotes[position]
+            content = quote['content'] if len(quote['content']) <= 1024 else quote['content'][:1021] + '...'
+            embed.add_field(name=f"#{position + 1} • {quote['author']}", value=content, inline=False)
+        embed.set_footer(text=f"Page {max(page, 1)}/{total_pages} • {total} match{'es' if total != 1 else ''}")
+        await ctx.respond(embed=embed)
+
+    def quote_list_page(self, guild_id, start):
+        """Embed listing the guild's quotes from position start; returns (embed, start shown, total)."""
+        total = self.store.count(guild_id)
+        start = min(max(start, 0), (total - 1) // LIST_PAGE_SIZE * LIST_PAGE_SIZE)
+        embed = discord.Embed(title="Saved Quotes", color=discord.Color.purple())
+        for position, quote in self.store.page(guild_id, start, LIST_PAGE_SIZE):
+            content = quote['content'] if len(quote['content']) <= 1024 else quote['content'][:1021] + '...'
+            embed.add_field(name=f"#{position + 1} • {quote['author']}", value=content, inline=False)
+        embed.set_footer(text=f"Quotes {start + 1}-{min(start + LIST_PAGE_SIZE, total)} of {total}")
+        return embed, start, total
+
+    def quote_list_view(self, start, total, user_id):
+        """Previous/next buttons whose custom_ids carry the position their page starts at."""
+        view = discord.ui.View(timeout=None, store=False)
+        for emoji, target in (("◀️", start - LIST_PAGE_SIZE), ("▶️", start + LIST_PAGE_SIZE)):
+            view.add_item(discord.ui.Button(
+                emoji=emoji, style=discord.ButtonStyle.secondary, disabled=not 0 <= target < total,
+                custom_id=self.bot.router.custom_id('ql', target, user_id, timeout=LIST_PROMPT_SECONDS)))
+        return view
+
+    @quotes.command(name='list', description="Browse this server's saved quotes in order.")
+    async def list_quotes(self, ctx: discord.ApplicationContext, start: int = 1):
+        """Page through this server's quotes starting at quote number start."""
+        if not self.store.count(ctx.guild.id):
+            await ctx.respond('No quotes saved yet!')
+            return
+        embed, start, total = self.quote_list_page(ctx.guild.id, start - 1)
+        # Paging buttons are handled by on_quote_list_page through the component router
+        view = self.quote_list_view(start, total, ctx.author.id) if total > LIST_PAGE_SIZE else None
+        await ctx.respond(embed=embed, view=view)
+
+    async def on_quote_list_page(self, interaction, start, user_id):
+        if interaction.user.id != int(user_id):
+            await interaction.response.send_message("Only the person who opened this list can turn its pages.", ephemeral=True)
+            return
+        embed, start, total = self.quote_list_page(interaction.guild.id, int(start))
+        await interaction.response.edit_message(embed=embed, view=self.quote_list_view(start, total, user_id))
+
+    @quotes.command(name='import', description='Save the pinned messages and/or the history of a channel as quotes.')
+    @commands.has_role("STAFF")
+    async def import_quotes(self, ctx: discord.ApplicationContext, channel: discord.TextChannel = None,
+                            source: discord.Option(str, "Where to take quotes from", choices=["pins", "history", "both"],
+                                                   default="pins") = "pins"):
+        """Import a channel's pins and/or messages as quotes, skipping anything already saved."""
+        channel = channel or ctx.channel
+        if ctx.guild.id in self.imports:
+            await ctx.respond("Quotes are already being imported in this server.")
+            return
+        if not channel.permissions_for(ctx.guild.me).read_message_history:
+            await ctx.respond(f"I can't read the history of {channel.mention}.", ephemeral=True)
+            return
+
+        quote_import = QuoteImport(self.store, channel, ctx.author, pins=source in ("pins", "both"),
+                                   history=source in ("history", "both"))
+        self.imports.add(ctx.guild.id)
+        # Progress goes to one channel message, since interaction responses stop being editable after 15 minutes
+        await ctx.respond(f"Importing quotes from {channel.mention}.")
+        progress = await ctx.channel.send("Quote import: starting...")
+
+        async def report(text):
+            try:
+                await progress.edit(content=f"Quote import: {text}")
+            except discord.HTTPException as e:
+                print(f"Error updating quote import progress: {e}")
+
+        try:
+            await quote_import.run(report)
+        except discord.HTTPException as e:
+            await report(f"stopped: {e}. {quote_import.progress()}; run again to continue.")
+            return
+        finally:
+            self.imports.discard(ctx.guild.id)
+        await report(f"done. {quote_import.progress()}.")
+
     @commands.user_command(name="Get Random Quote")
     async def get_user_quote(self, ctx: discord.ApplicationContext, user: discord.Member):
         """Right-click menu command to get a random quote from a user."""
-        quotes = load_quotes()
-        
-        if not quotes:
+        if not self.store.count(ctx.guild.id):
             await ctx.respond('No quotes saved yet!', ephemeral=True)
             return
         
-        # Filter quotes by this user
-        user_quotes = [q for q in quotes if q['author_id'] == user.id]
+        # Pick from this user's indexed quotes
+        quote = self.store.random(ctx.guild.id, user.id)
         
-        if not user_quotes:
+        if quote is None:
             await ctx.respond(f'No quotes saved from {user.display_name} yet!', ephemeral=True)
             return
+        count = self.store.count(ctx.guild.id, user.id)
         
-        # Show a random quote from this user
-        quote = random.choice(user_quotes)
         embed = discord.Embed(
             description=quote['content'], 
             color=discord.Color.purple(),
             title=f"Quote from {user.display_name}"
         )
         embed.set_author(name=f"{quote['author']}", icon_url=user.avatar.url if user.avatar else user.default_avatar.url)
-        embed.set_footer(text=f"Saved by {quote['saved_by']} • {len(user_quotes)} total quote{'s' if len(user_quotes) != 1 else ''}")
+        embed.set_footer(text=f"Saved by {quote['saved_by']} • {count} total quote{'s' if count != 1 else ''}")
         
         await ctx.respond(embed=embed)
 
@@ -121,31 +241,15 @@ class Quotes(commands.Cog):
     async def save_message_as_quote(self, ctx: discord.ApplicationContext, message: discord.Message):
         """Right-click context menu command to save a message as a quote."""
         
-        # Don't save empty messages or bot messages
-        if not message.content or message.author.bot:
-            await ctx.respond('Cannot save this message as a quote!', ephemeral=True)
+        problem = self.store.check_message(ctx.guild.id, message)
+        if problem:
+            await ctx.respond(problem, ephemeral=True)
             return
         
-        quotes = load_quotes()
-        
-        # Check if this exact quote already exists
-        for q in quotes:
-            if q['content'] == message.content and q['author_id'] == message.author.id:
-                await ctx.respond('This quote has already been saved!', ephemeral=True)
-                return
-        
         # Save the quote
-        quote_entry = {
-            'content': message.content,
-            'author': str(message.author),
-            'author_id': message.author.id,
-            'saved_by': str(ctx.author),
-            'saved_by_id': ctx.author.id,
-            'channel_id': ctx.channel.id,
-            'guild_id': ctx.guild.id
-        }
-        quotes.append(quote_entry)
-        save_quotes(quotes)
+        quote_entry = new_quote(message.content, str(message.author), message.author.id,
+                                str(ctx.author), ctx.author.id, ctx.channel.id, ctx.guild.id)
+        self.store.add(quote_entry)
         
         # Show confirmation with the saved quote
         embed = discord.Embed(
@@ -2,10 +2,8 @@
 # Underground Grotto
 #***************************************************************************#
 
-import os
 import platform
 import discord
-import json5
 
 from cogs.base import Base
 from cogs.fun import Fun 
@@ -14,22 +12,48 @@ from cogs.birthday import Birthday
 from cogs.quotes import Quotes 
 from cogs.marioparty import MarioParty
 from cogs.music import Music
+from util.checkpoint import CHECKPOINT_FILE, CheckpointFile
+from util.config import get_settings
+from util.router import ComponentRouter
+from util.scheduler import Scheduler
+from util.storage import Storage, create_backend
 
 from discord.ext import tasks
 from discord.ext import commands
 
 # Load configuration
-def load_config():
-    if not os.path.exists('config.json5'):
-        return {}
-    with open('config.json5', 'r') as f:
-        return json5.load(f)
+config = get_settings()
 
 #Intents
 intents = discord.Intents.all()
 
 #Define Client
-bot = commands.Bot(command_prefix=commands.when_mentioned_or("/"), intents=intents, activity=discord.Game(name='Mario Party Mayhem'))
+class GrottoBot(commands.Bot):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.storage = Storage(create_backend(config))  # Shared database, created before any cog needs it
+        self.checkpoints = CheckpointFile(config.get('checkpoint_file', CHECKPOINT_FILE))  # Progress of long-running jobs
+        self.scheduler = Scheduler()  # Timed jobs such as the birthday rollover at local midnight
+        self.router = ComponentRouter()  # Buttons, selects and modals, dispatched by custom_id prefix
+        self.add_listener(self.router.dispatch, 'on_interaction')
+
+    async def close(self):
+        # Persist anything the cogs are still buffering before the connection goes away
+        leveling = self.get_cog('Leveling')
+        if leveling:
+            await leveling.drain_xp_queue()
+        quotes = self.get_cog('Quotes')
+        if quotes:
+            await quotes.save_search_index()
+        self.scheduler.close()
+        try:
+            await self.checkpoints.flush()
+        except OSError as e:
+            print(f"Error saving checkpoints on shutdown: {e}")
+        await self.storage.close()
+        await super().close()
+
+bot = GrottoBot(command_prefix=commands.when_mentioned_or("/"), intents=intents, activity=discord.Game(name='Mario Party Mayhem'))
 
 @bot.event
 async def on_ready():
@@ -58,8 +82,7 @@ bot.add_cog(MarioParty(bot))
 bot.add_cog(Music(bot))
 
 #Run Bot
-config = load_config()
-TOKEN = config.get('bot_token')
+TOKEN = config.bot_token
 
 if not TOKEN:
     print("Error: No bot token found in config.json5!")
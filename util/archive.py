@@ -0,0 +1,83 @@
+#***************************************************************************#
+# Underground Grotto
+#***************************************************************************#
+
+import sqlite3
+import time
+
+# Level data of members who left, kept out of memory until they come back
+ARCHIVE_FILE = 'levels_archive.sqlite3'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS archived_levels (
+    guild_id INTEGER NOT NULL,
+    user_id INTEGER NOT NULL,
+    total_xp INTEGER NOT NULL,
+    archived_at REAL NOT NULL,
+    PRIMARY KEY (guild_id, user_id)
+) WITHOUT ROWID;
+"""
+
+class LevelArchive:
+    """Cold storage for the level entries of departed members and guilds.
+
+    Nothing is read at startup; entries are looked up by (guild, user)
+    only when someone returns. Every method blocks on SQLite and is meant
+    to be run in a worker thread, each call on its own connection.
+    """
+
+    def __init__(self, path=ARCHIVE_FILE):
+        self.path = path
+
+    def connect(self):
+        conn = sqlite3.connect(self.path)
+        conn.executescript(SCHEMA)
+        return conn
+
+    def store(self, guild_id, entries):
+        """Archive (user_id, total_xp) entries of a guild, adding to anything already archived for them.
+
+        The caller drops the entries from storage and flushes that before
+        storing, so a retried archive never finds the same live XP twice.
+        """
+        now = time.time()
+        conn = self.connect()
+        try:
+            with conn:
+                conn.executemany(
+                    'INSERT INTO archived_levels (guild_id, user_id, total_xp, archived_at) VALUES (?, ?, ?, ?) '
+                    'ON CONFLICT (guild_id, user_id) DO UPDATE SET total_xp = total_xp + excluded.total_xp, '
+                    'archived_at = excluded.archived_at',
+                    [(int(guild_id), user_id, total_xp, now) for user_id, total_xp in entries])
+        finally:
+            conn.close()
+
+    def user_ids(self, guild_id):
+        """IDs of every archived user of a guild."""
+        conn = self.connect()
+        try:
+            return [user_id for (user_id,) in conn.execute('SELECT user_id FROM archived_levels WHERE guild_id = ?', (int(guild_id),))]
+        finally:
+            conn.close()
+
+    def take(self, guild_id, user_ids=None):
+        """Remove and return {user_id: total_xp} for the given users of a guild (all of them when user_ids is None)."""
+        conn = self.connect()
+        try:
+            with conn:
+                if user_ids is None:
+                    rows = conn.execute('SELECT user_id, total_xp FROM archived_levels WHERE guild_id = ?',
+                                        (int(guild_id),)).fetchall()
+                    conn.execute('DELETE FROM archived_levels WHERE guild_id = ?', (int(guild_id),))
+                else:
+                    rows = []
+                    for user_id in user_ids:
+                        row = conn.execute('SELECT user_id, total_xp FROM archived_levels WHERE guild_id = ? AND user_id = ?',
+                                           (int(guild_id), user_id)).fetchone()
+                        if row:
+                            rows.append(row)
+                    conn.executemany('DELETE FROM archived_levels WHERE guild_id = ? AND user_id = ?',
+                                     [(int(guild_id), user_id) for user_id, total_xp in rows])
+            return dict(rows)
+        finally:
+            conn.close()
@@ -0,0 +1,112 @@
+#***************************************************************************#
+# Underground Grotto
+#***************************************************************************#
+
+import asyncio
+import time
+
+import discord
+
+from util.cooldown import CooldownTable
+
+class XpBackfill:
+    """Awards XP for a guild's message history from before the bot joined.
+
+    Every readable text channel is streamed oldest first with
+    channel.history(), at most concurrency channels at a time. Messages
+    are tallied per user for batch_size messages, the tally is awarded and
+    written, and only then is the batch's last message ID checkpointed;
+    an interrupted run resumes after it, and finished channels are never
+    read again. Only the tally, the cooldown buckets of recently active
+    users and the current page of history are held, so memory doesn't
+    grow with the amount of history.
+    """
+
+    JOB = 'xp_backfill'
+
+    def __init__(self, guild, award, flush, checkpoints, before, xp_per_message, cooldown, burst,
+                 concurrency=3, batch_size=500, progress_interval=5.0):
+        self.guild = guild
+        self.award = award  # Coroutine (guild_id, user_id, amount) applying an XP award
+        self.flush = flush  # Coroutine writing the applied awards to storage
+        self.checkpoints = checkpoints
+        self.before = before  # Messages from here on already earned XP live
+        self.xp_per_message = xp_per_message
+        self.cooldown = cooldown
+        self.burst = burst
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.batch_size = batch_size
+        self.progress_interval = progress_interval
+        self.state = checkpoints.get(self.JOB, guild.id) or {}  # Channel ID -> {"after": message ID, "done": bool}
+        self.resumed = bool(self.state)
+        self.scanned = 0
+        self.awarded = 0
+        self.failed = []
+        self.channels_done = sum(1 for channel_state in self.state.values() if channel_state.get('done'))
+        self.channel_count = 0
+        self._last_report = 0.0
+
+    def progress(self):
+        return (f"{self.channels_done}/{self.channel_count} channels done, "
+                f"{self.scanned} messages scanned, {self.awarded} earned XP")
+
+    def channels(self):
+        me = self.guild.me
+        return [channel for channel in self.guild.text_channels
+                if channel.permissions_for(me).read_message_history
+                and not self.state.get(str(channel.id), {}).get('done')]
+
+    async def _apply(self, channel, tally, last_id, done=False):
+        # Award and write before checkpointing, so a resumed run never counts a message twice
+        for user_id, amount in tally.items():
+            await self.award(str(self.guild.id), user_id, amount)
+        await self.flush()
+        self.awarded += sum(tally.values()) // self.xp_per_message
+        self.state[str(channel.id)] = {'after': last_id, 'done': done}
+        self.checkpoints.set(self.JOB, self.guild.id, self.state)
+        # The awards are on disk; wait for the checkpoint too, so a crash can't replay the batch.
+        # If it can't be written this raises, and the channel stops rather than reading on
+        await self.checkpoints.flush()
+
+    async def _scan(self, channel, report):
+        async with self.semaphore:
+            after = self.state.get(str(channel.id), {}).get('after')
+            # Cooldowns are tracked per channel, since each channel's history is read in its own order
+            buckets = CooldownTable()
+            tally = {}  # User ID -> XP earned in this batch
+            count = 0
+            last_id = after
+            try:
+                async for message in channel.history(limit=None, after=after and discord.Object(id=after),
+                                                     before=self.before, oldest_first=True):
+                    last_id = message.id
+                    count += 1
+                    if not message.author.bot:
+                        now = message.created_at.timestamp()
+                        if self.cooldown <= 0 or buckets.hit(message.author.id, now, self.cooldown, self.burst):
+                            tally[message.author.id] = tally.get(message.author.id, 0) + self.xp_per_message
+                    if count >= self.batch_size:
+                        self.scanned += count
+                        await self._apply(channel, tally, last_id)
+                        buckets.prune(message.created_at.timestamp())
+                        tally, count = {}, 0
+                        await self._report(report)
+                self.scanned += count
+                await self._apply(channel, tally, last_id, done=True)
+                self.channels_done += 1
+            except (discord.HTTPException, OSError) as e:
+                print(f"Error backfilling XP from #{channel.name}: {e}")
+                self.failed.append(channel.name)
+            await self._report(report)
+
+    async def _report(self, report):
+        if report and time.monotonic() - self._last_report >= self.progress_interval:
+            self._last_report = time.monotonic()
+            await report(self.progress())
+
+    async def run(self, report=None):
+        """Backfill every channel not finished yet; report(text) is awaited at most every progress_interval seconds."""
+        channels = self.channels()
+        self.channel_count = self.channels_done + len(channels)
+        # The finished checkpoint stays behind, so running the backfill again can't award the same history twice
+        await asyncio.gather(*(self._scan(channel, report) for channel in channels))
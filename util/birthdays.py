@@ -0,0 +1,77 @@
+#***************************************************************************#
+# Underground Grotto
+#***************************************************************************#
+
+import calendar
+import dataclasses
+
+def parse_birthday(birthday):
+    """(month, day) of a stored "YYYY-MM-DD" birthday; the year is a placeholder and ignored."""
+    _, month, day = birthday.split('-')
+    return int(month), int(day)
+
+def days_in_month(month):
+    """Longest the month gets, counting February 29."""
+    return calendar.monthrange(2000, month)[1]
+
+class BirthdayIndex:
+    """One guild's opted-in birthdays grouped by (month, day).
+
+    The daily job reads one bucket per guild instead of scanning every
+    birthday.
+    """
+
+    def __init__(self):
+        self.by_date = {}  # (month, day) -> set of user IDs
+        self.dates = {}  # User ID -> (month, day)
+
+    def __len__(self):
+        return len(self.dates)
+
+    def __contains__(self, user_id):
+        return user_id in self.dates
+
+    def set(self, user_id, month, day):
+        self.remove(user_id)
+        self.dates[user_id] = (month, day)
+        self.by_date.setdefault((month, day), set()).add(user_id)
+
+    def remove(self, user_id):
+        old = self.dates.pop(user_id, None)
+        if old is not None:
+            users = self.by_date[old]
+            users.discard(user_id)
+            if not users:
+                del self.by_date[old]
+
+    def users_on(self, day):
+        """IDs of the users celebrating on a date; February 29 birthdays fall on February 28 in other years."""
+        users = set(self.by_date.get((day.month, day.day), ()))
+        if day.month == 2 and day.day == 28 and not calendar.isleap(day.year):
+            users |= self.by_date.get((2, 29), set())
+        return users
+
+@dataclasses.dataclass(frozen=True)
+class GuildBirthdaySettings:
+    channel_id: int = 0  # Where birthdays are announced; 0 for nowhere
+    role_id: int = 0  # Role held for the day; 0 for none
+
+class BirthdaySettingsCache:
+    """GuildBirthdaySettings per guild, parsed once from the birthday_guilds section.
+
+    Lookups are a dict hit; invalidate() a guild after changing its entry.
+    """
+
+    def __init__(self, storage):
+        self.storage = storage
+        self._cache = {}
+
+    def get(self, guild_id):
+        settings = self._cache.get(guild_id)
+        if settings is None:
+            entry = self.storage.birthday_guilds.get(guild_id, {})
+            settings = self._cache[guild_id] = GuildBirthdaySettings(int(entry.get('channel_id') or 0), int(entry.get('role_id') or 0))
+        return settings
+
+    def invalidate(self, guild_id):
+        self._cache.pop(guild_id, None)
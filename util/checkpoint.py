@@ -0,0 +1,89 @@
+#***************************************************************************#
+# Underground Grotto
+#***************************************************************************#
+
+import asyncio
+import json
+import os
+
+from util.storage import atomic_write
+
+# Progress of long-running jobs, so they can pick up where they stopped
+CHECKPOINT_FILE = 'checkpoints.json'
+
+class CheckpointFile:
+    """Small JSON file of job progress keyed by (job, key), e.g. ('role_sync', guild_id).
+
+    set() and clear() update memory and hand the file rewrite to a writer
+    task that runs atomic_write on a worker thread, so the event loop never
+    waits on fsync; changes made while a write is in flight are coalesced
+    into the next one. flush() waits until everything is on disk, and
+    raises OSError if the last write failed.
+    """
+
+    def __init__(self, path=CHECKPOINT_FILE):
+        self.path = path
+        self.data = {}
+        self._dirty = False
+        self._writer = None
+        self._error = None  # Why the last write failed, until one succeeds
+        if os.path.exists(path):
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    self.data = json.load(f)
+            except ValueError as e:
+                print(f"Error reading {path}, starting without checkpoints: {e}")
+
+    def get(self, job, key, default=None):
+        return self.data.get(job, {}).get(str(key), default)
+
+    def set(self, job, key, value):
+        self.data.setdefault(job, {})[str(key)] = value
+        self._schedule()
+
+    def clear(self, job, key):
+        if self.data.get(job, {}).pop(str(key), None) is not None:
+            if not self.data[job]:
+                del self.data[job]
+            self._schedule()
+
+    def _schedule(self):
+        self._dirty = True
+        if self._writer is not None and not self._writer.done():
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # No event loop (e.g. a script), so just write now
+            self._dirty = False
+            atomic_write(self.path, self._encode())
+            return
+        self._writer = loop.create_task(self._write_loop())
+
+    def _encode(self):
+        # Encoded on the event loop so the data can't change mid-dump
+        return json.dumps(self.data, ensure_ascii=False, indent=4)
+
+    async def _write_loop(self):
+        loop = asyncio.get_running_loop()
+        while self._dirty:
+            self._dirty = False
+            try:
+                await loop.run_in_executor(None, atomic_write, self.path, self._encode())
+            except Exception as e:
+                # The next set() or flush() tries again
+                self._dirty = True
+                self._error = e
+                print(f"Error writing {self.path}: {e}")
+                return
+            self._error = None
+
+    async def flush(self):
+        """Wait until every change made so far is written; raises OSError if it couldn't be."""
+        if self._writer is not None and not self._writer.done():
+            await asyncio.shield(self._writer)
+        if self._dirty:
+            self._writer = asyncio.get_running_loop().create_task(self._write_loop())
+            await asyncio.shield(self._writer)
+        if self._dirty:
+            raise OSError(f"Could not write {self.path}") from self._error
@@ -0,0 +1,108 @@
+#***************************************************************************#
+# Underground Grotto
+#***************************************************************************#
+
+import dataclasses
+import os
+import time
+
+import json5
+
+# Bot configuration file
+CONFIG_FILE = 'config.json5'
+
+@dataclasses.dataclass(frozen=True)
+class Settings:
+    """Parsed config.json5 with the keys the cogs use, converted to their types."""
+
+    owner_id: int = 0
+    bot_token: str = ''
+    timezone: str = 'America/New_York'
+    birthday_channel_id: int = 0
+    birthday_role_id: int = 0
+    xp_per_message: int = 10
+    xp_per_voice_minute: float = 5
+    xp_cooldown: float = 10
+    xp_burst: int = 3
+    xp_level_step: int = 250
+    xp_flush_interval: float = 30
+    xp_flush_threshold: int = 100
+    xp_queue_size: int = 10000
+    xp_batch_size: int = 500
+    guild_idle_seconds: float = 900
+    retention_interval_hours: float = 24
+    level_inactive_days: float = 0
+    global_leaderboard_size: int = 100
+    global_leaderboard_ttl: float = 60
+    role_sync_concurrency: int = 4
+    backfill_concurrency: int = 3
+    level_roles: dict = dataclasses.field(default_factory=dict)
+    raw: dict = dataclasses.field(default_factory=dict)  # Every key exactly as parsed
+
+    @classmethod
+    def from_dict(cls, values):
+        typed = {}
+        for field in dataclasses.fields(cls):
+            if field.name == 'raw' or values.get(field.name) is None:
+                continue
+            try:
+                typed[field.name] = field.type(values[field.name])
+            except (TypeError, ValueError):
+                print(f"Ignoring invalid value for '{field.name}' in {CONFIG_FILE}: {values[field.name]!r}")
+        return cls(raw=dict(values), **typed)
+
+    def get(self, key, default=None):
+        return self.raw.get(key, default)
+
+class ConfigLoader:
+    """Parses the config file once and re-parses it only when its mtime changes.
+
+    The mtime is checked with a stat at most every check_interval seconds,
+    so reading settings on a hot path costs a clock read, not a parse.
+    """
+
+    def __init__(self, path=CONFIG_FILE, check_interval=5.0):
+        self.path = path
+        self.check_interval = check_interval
+        self._settings = Settings()
+        self._mtime = None
+        self._next_check = 0.0
+
+    def _stat(self):
+        try:
+            return os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def reload(self):
+        """Parse the file now, keeping the previous settings if it is broken."""
+        mtime = self._stat()
+        if mtime is None:
+            self._settings = Settings()
+        else:
+            try:
+                with open(self.path, 'r', encoding='utf-8') as f:
+                    self._settings = Settings.from_dict(json5.load(f))
+            except ValueError as e:
+                print(f"Error reading {self.path}, keeping the previous settings: {e}")
+        self._mtime = mtime
+        return self._settings
+
+    @property
+    def settings(self):
+        now = time.monotonic()
+        if now >= self._next_check:
+            self._next_check = now + self.check_interval
+            if self._mtime is None or self._stat() != self._mtime:
+                self.reload()
+        return self._settings
+
+# Shared loader used by every cog
+config = ConfigLoader()
+
+def get_settings():
+    """Current Settings, hot-reloaded when config.json5 changes."""
+    return config.settings
+
+def get_setting(key, default=None):
+    return config.settings.get(key, default)
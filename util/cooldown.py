@@ -0,0 +1,72 @@
+#***************************************************************************#
+# Underground Grotto
+#***************************************************************************#
+
+from array import array
+
+class CooldownTable:
+    """Token-bucket XP cooldowns of one guild's users: a user ID -> row dict over one float column.
+
+    Each user keeps only the time their bucket will be full again (the
+    "theoretical arrival time" of a generic cell rate algorithm): an award
+    is allowed while that time is at most (burst - 1) cooldowns ahead, and
+    each award pushes it one cooldown further. A check is a dict lookup and
+    an array read, with nothing allocated for users already tracked.
+
+    Users whose bucket has refilled carry no information, so prune() drops
+    them and the table only ever holds recently active users.
+    """
+
+    __slots__ = ('slots', 'full_at')
+
+    def __init__(self):
+        self.slots = {}  # User ID -> row in full_at
+        self.full_at = array('d')
+
+    def __len__(self):
+        return len(self.slots)
+
+    def hit(self, user_id, now, cooldown, burst):
+        """Take a token for the user if one is left; returns whether the award may happen."""
+        row = self.slots.get(user_id)
+        if row is None:
+            self.slots[user_id] = len(self.full_at)
+            self.full_at.append(now + cooldown)
+            return True
+        full_at = self.full_at[row]
+        if full_at - now > (burst - 1) * cooldown:
+            return False
+        self.full_at[row] = (full_at if full_at > now else now) + cooldown
+        return True
+
+    def prune(self, now):
+        """Forget users whose bucket is full again; returns how many were dropped."""
+        keep = [(user_id, self.full_at[row]) for user_id, row in self.slots.items() if self.full_at[row] > now]
+        dropped = len(self.slots) - len(keep)
+        if dropped:
+            self.slots = {user_id: row for row, (user_id, full_at) in enumerate(keep)}
+            self.full_at = array('d', [full_at for user_id, full_at in keep])
+        return dropped
+
+class XpCooldowns:
+    """CooldownTable per guild, keyed by the integer guild ID."""
+
+    def __init__(self):
+        self.guilds = {}
+
+    def __len__(self):
+        return sum(len(table) for table in self.guilds.values())
+
+    def hit(self, guild_id, user_id, now, cooldown, burst):
+        table = self.guilds.get(guild_id)
+        if table is None:
+            table = self.guilds[guild_id] = CooldownTable()
+        return table.hit(user_id, now, cooldown, burst)
+
+    def prune(self, now):
+        dropped = 0
+        for guild_id, table in list(self.guilds.items()):
+            dropped += table.prune(now)
+            if not table:
+                del self.guilds[guild_id]
+        return dropped
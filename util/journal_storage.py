@@ -0,0 +1,128 @@
+#***************************************************************************#
+# Underground Grotto
+#***************************************************************************#
+
+import json
+import os
+
+from util.leveltable import LevelTable, level_for_xp, total_xp_of
+from util.storage import JsonBackend, LEVELS_FILE
+
+def lookup(data, section, key):
+    """Current value stored under a change key, or None if it was removed."""
+    if section == 'levels':
+        guild_id, user_id = key
+        table = data['levels'].get(guild_id)
+        entry = table.get(user_id) if table is not None else None
+        if entry is None:
+            return None
+        return {"level": entry[0], "total_xp": entry[1], "last_award": table.last_award_of(user_id)}
+    if section == 'quotes':
+        guild_id, index = key
+        return data['quotes'][guild_id][index]
+    return data[section].get(key[0])
+
+def apply(data, section, key, value):
+    """Replay one journal record onto the in-memory document."""
+    if section == 'levels':
+        guild_id, user_id = key
+        if value is None:
+            if guild_id in data['levels']:
+                data['levels'][guild_id].remove(int(user_id))
+        else:
+            total_xp = total_xp_of(value)
+            data['levels'].setdefault(guild_id, LevelTable()).set(int(user_id), level_for_xp(total_xp), total_xp,
+                                                                  value.get('last_award'))
+    elif section == 'quotes':
+        # Records written before quotes were split by guild have just the index into one list
+        if len(key) == 1 and isinstance(data['quotes'], list):
+            quotes = data['quotes']
+        elif len(key) == 1:
+            # The snapshot is already split (a crash came after the migration snapshot but
+            # before the journal was emptied), so the old record's global index means nothing
+            # here; it is placed by its own guild unless an identical quote is already there
+            quotes = data['quotes'].setdefault(str(value.get('guild_id')), [])
+            if value not in quotes:
+                quotes.append(value)
+            return
+        else:
+            quotes = data['quotes'].setdefault(key[0], [])
+        index = key[-1]
+        if index < len(quotes):
+            quotes[index] = value
+        else:
+            quotes.append(value)
+    elif value is None:
+        data[section].pop(key[0], None)
+    else:
+        data[section][key[0]] = value
+
+class JournalBackend(JsonBackend):
+    """db.json snapshot plus an append-only journal of the changes made since.
+
+    Each flush appends one JSON line per changed key, so a write costs the
+    size of the change rather than the size of the database. Records hold
+    the new value (not a delta), which keeps replay idempotent: once the
+    journal grows past compact_bytes the next commit folds it into a fresh
+    snapshot, and a crash between the two steps only replays records the
+    snapshot already contains.
+    """
+
+    def __init__(self, path='db.json', journal_path='db.journal', levels_path=LEVELS_FILE, binary=False, compact_bytes=1024 * 1024):
+        super().__init__(path, levels_path, binary)
+        self.journal_path = journal_path
+        self.compact_bytes = compact_bytes
+        self.journal_size = 0
+
+    def load(self):
+        data = super().load()
+        if not os.path.exists(self.journal_path):
+            return data
+        replayed = 0
+        good_size = 0  # Bytes up to the end of the last intact record
+        with open(self.journal_path, 'rb') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # A crash mid-append leaves a torn record at the end
+                    print(f"Dropping damaged journal record in {self.journal_path}")
+                    break
+                apply(data, record['section'], record['key'], record['value'])
+                replayed += 1
+                good_size += len(line)
+        if good_size != os.path.getsize(self.journal_path):
+            # Cut the torn tail off so new records don't get appended to it
+            os.truncate(self.journal_path, good_size)
+        self.journal_size = good_size
+        if replayed:
+            print(f"Replayed {replayed} journal records from {self.journal_path}")
+        return data
+
+    def prepare(self, data, changes):
+        if changes is None:
+            self.journal_size = 0
+            return None, super().prepare(data, changes)
+        lines = ''.join(
+            json.dumps({'section': section, 'key': key, 'value': lookup(data, section, key)}, ensure_ascii=False) + '\n'
+            for section, *key in changes)
+        self.journal_size += len(lines.encode('utf-8'))
+        snapshot = None
+        if self.journal_size >= self.compact_bytes:
+            snapshot = super().prepare(data, None)
+            self.journal_size = 0
+        return lines, snapshot
+
+    def commit(self, payload):
+        lines, snapshot = payload
+        if lines:
+            with open(self.journal_path, 'a', encoding='utf-8') as f:
+                f.write(lines)
+                f.flush()
+                os.fsync(f.fileno())
+        if snapshot is not None:
+            # The snapshot already contains every journaled change, so the
+            # journal can start over once it is safely on disk
+            super().commit(snapshot)
+            with open(self.journal_path, 'w', encoding='utf-8'):
+                pass
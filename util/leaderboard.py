@@ -0,0 +1,180 @@
+#***************************************************************************#
+# Underground Grotto
+#***************************************************************************#
+
+import heapq
+import json
+import os
+
+from sortedcontainers import SortedList
+
+from util.storage import atomic_write
+
+# Top users of every guild, so the global leaderboard doesn't read every guild's levels
+TOPS_FILE = 'leaderboard_tops.json'
+
+class LeaderboardIndex:
+    """One guild's users kept in leaderboard order, updated as XP is awarded.
+
+    Entries are (-total_xp, user_id) so the best users sort first; rank
+    lookups are a bisect and a page is a slice, both O(log n).
+    """
+
+    __slots__ = ('entries',)
+
+    def __init__(self, entries=()):
+        self.entries = SortedList(entries)
+
+    @classmethod
+    def build(cls, table):
+        """Index every user of a LevelTable."""
+        return cls((-total_xp, user_id) for user_id, level, total_xp in table.items())
+
+    def __len__(self):
+        return len(self.entries)
+
+    def update(self, user_id, old_xp, new_xp):
+        """Move a user from their old total XP to the new one; old_xp is None for new users."""
+        if old_xp is not None:
+            self.entries.remove((-old_xp, user_id))
+        if new_xp is not None:
+            self.entries.add((-new_xp, user_id))
+
+    def rank(self, total_xp):
+        """Rank for a total XP; users with the same total share the same rank."""
+        return self.entries.bisect_left((-total_xp,)) + 1
+
+    def page(self, start, count):
+        """(user_id, rank, total_xp) for count users starting at position start."""
+        rows = []
+        for neg_xp, user_id in self.entries.islice(start, start + count):
+            rows.append((user_id, self.rank(-neg_xp), -neg_xp))
+        return rows
+
+def merge_top(guilds, count):
+    """Top count users across several guilds as (user_id, guild_id, total_xp).
+
+    guilds maps guild IDs to their (-total_xp, user_id) entries in sorted
+    order, such as LeaderboardIndex.entries or a GuildTops list. A
+    heap-based k-way merge reads only as far into each one as the overall
+    top count reaches, instead of sorting every user of every guild. A
+    user in several guilds is ranked by their best guild.
+    """
+    def entries(guild_id, sorted_entries):
+        for neg_xp, user_id in sorted_entries:
+            yield neg_xp, user_id, guild_id
+
+    rows = []
+    seen = set()
+    for neg_xp, user_id, guild_id in heapq.merge(*(entries(guild_id, sorted_entries) for guild_id, sorted_entries in guilds.items())):
+        if user_id in seen:
+            continue
+        seen.add(user_id)
+        rows.append((user_id, guild_id, -neg_xp))
+        if len(rows) >= count:
+            break
+    return rows
+
+class GuildTops:
+    """The size best (-total_xp, user_id) entries of every guild, updated as XP is awarded and saved to a small file.
+
+    A user in the global top size is within the top size of their best
+    guild, so merging these short lists gives the same global leaderboard
+    as merging whole guilds, without reading partitions that were evicted
+    from memory. Guilds missing here (before the first save) have to be
+    refreshed from their full index once.
+    """
+
+    def __init__(self, size=100):
+        self.size = size
+        self.tops = {}  # Guild ID -> SortedList of (-total_xp, user_id)
+        self.xp = {}  # Guild ID -> {user ID: total XP} of the users in the guild's top
+        self.dirty = False
+
+    def update(self, guild_id, user_id, total_xp):
+        top = self.tops.get(guild_id)
+        if top is None:
+            # Unknown guilds stay unknown until refresh() reads them whole
+            return
+        members = self.xp[guild_id]
+        old = members.pop(user_id, None)
+        if old is not None:
+            top.remove((-old, user_id))
+        entry = (-total_xp, user_id)
+        if len(top) < self.size or entry < top[-1]:
+            top.add(entry)
+            members[user_id] = total_xp
+            if len(top) > self.size:
+                _, dropped = top.pop()
+                del members[dropped]
+            self.dirty = True
+        elif old is not None:
+            self.dirty = True
+
+    def remove(self, guild_id, user_id):
+        """Take a user out of their guild's top; the guild has fewer than size entries until its next refresh()."""
+        old = self.xp.get(guild_id, {}).pop(user_id, None)
+        if old is not None:
+            self.tops[guild_id].remove((-old, user_id))
+            self.dirty = True
+
+    def refresh(self, guild_id, index):
+        """Replace the guild's top with the first entries of its full LeaderboardIndex."""
+        entries = list(index.entries.islice(0, self.size))
+        if self.tops.get(guild_id) != entries:
+            self.tops[guild_id] = SortedList(entries)
+            self.xp[guild_id] = {user_id: -neg_xp for neg_xp, user_id in entries}
+            self.dirty = True
+
+    def load(self, path=TOPS_FILE):
+        if not os.path.exists(path):
+            return
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                saved = json.load(f)
+        except ValueError as e:
+            print(f"Error reading {path}, rebuilding the guild tops: {e}")
+            return
+        for guild_id, entries in saved.items():
+            self.tops[guild_id] = SortedList((-total_xp, user_id) for user_id, total_xp in entries[:self.size])
+            self.xp[guild_id] = {user_id: -neg_xp for neg_xp, user_id in self.tops[guild_id]}
+
+    def encode(self):
+        """The tops as JSON text for save(); run on the event loop so they can't change mid-dump."""
+        self.dirty = False
+        return json.dumps({guild_id: [[user_id, -neg_xp] for neg_xp, user_id in top] for guild_id, top in self.tops.items()})
+
+    @staticmethod
+    def save(text, path=TOPS_FILE):
+        atomic_write(path, text)
+
+class GlobalLeaderboard:
+    """Cached global leaderboard rows (total XP last in each row), kept for at most ttl seconds.
+
+    award() drops the cache as soon as a new total could enter or reorder
+    the top entries; awards further down the table leave it alone.
+    """
+
+    def __init__(self, size=100, ttl=60.0):
+        self.size = size
+        self.ttl = ttl
+        self.rows = None
+        self.expires = 0.0
+
+    def get(self, now):
+        """The cached rows, or None if they have to be merged again."""
+        if self.rows is not None and now < self.expires:
+            return self.rows
+        return None
+
+    def store(self, rows, now):
+        self.rows = rows
+        self.expires = now + self.ttl
+
+    def award(self, total_xp):
+        rows = self.rows
+        if rows is not None and (len(rows) < self.size or total_xp >= rows[-1][-1]):
+            self.rows = None
+
+    def invalidate(self):
+        self.rows = None
@@ -0,0 +1,246 @@
+#***************************************************************************#
+# Underground Grotto
+#***************************************************************************#
+
+import json
+import math
+import mmap
+import os
+import struct
+import sys
+import time
+from array import array
+from bisect import bisect_left
+
+import numpy as np
+
+from util.config import get_settings
+
+# Binary level snapshot: a header, then one block of columns per guild.
+# Version 1 stored XP since the last level-up; version 2 stores total XP;
+# version 3 adds the last award time.
+SNAPSHOT_MAGIC = b'GLVL'
+SNAPSHOT_VERSION = 3
+HEADER = struct.Struct('<4sII')  # magic, version, guild count
+GUILD_HEADER = struct.Struct('<QI')  # guild ID, user count
+
+# Level curve: going from level L to L + 1 takes step * L XP, so reaching
+# level L from level 1 takes step * L * (L - 1) / 2 XP in total
+def xp_needed(level, step=None):
+    """XP needed to go from level to level + 1."""
+    return (step or get_settings().xp_level_step) * level
+
+def xp_for_level(level, step=None):
+    """Total XP at which a user reaches level."""
+    return (step or get_settings().xp_level_step) * level * (level - 1) // 2
+
+def level_for_xp(total_xp, step=None):
+    """Level reached with total_xp, the closed-form inverse of xp_for_level."""
+    # step * L * (L - 1) / 2 <= total_xp  <=>  (2L - 1)^2 <= 4q + 1, with q = 2 * total_xp // step
+    q = 2 * total_xp // (step or get_settings().xp_level_step)
+    return (math.isqrt(4 * q + 1) + 1) // 2
+
+def levels_for_xp(total_xp, step=None):
+    """level_for_xp over a whole column of total XP at once."""
+    step = step or get_settings().xp_level_step
+    n = (2 * np.asarray(total_xp, dtype=np.uint64) // np.uint64(step)) * np.uint64(4) + np.uint64(1)
+    root = np.sqrt(n.astype(np.float64)).astype(np.uint64)
+    # Float square roots can be one off for large values; settle them to the exact isqrt
+    root -= (root * root > n).astype(np.uint64)
+    root += ((root + 1) * (root + 1) <= n).astype(np.uint64)
+    return ((root + 1) // 2).astype(np.uint32)
+
+def total_xp_of(entry):
+    """Total XP of a stored {"level": .., "total_xp": ..} entry, converting the old per-level form."""
+    if 'total_xp' in entry:
+        return entry['total_xp']
+    return xp_for_level(entry['level']) + entry['xp']
+
+class LevelTable:
+    """One guild's level data stored as parallel array columns sorted by user ID.
+
+    A user costs 20 bytes (uint64 ID, uint32 level, uint32 total XP,
+    uint32 Unix time of their last award) instead of a string key plus a
+    dict, and lookups are a binary search over the ID column. Total XP is
+    the source of truth; the level column is derived from it and can be
+    recomputed in one pass when the curve changes.
+    """
+
+    __slots__ = ('ids', 'levels', 'xp', 'last_award')
+
+    def __init__(self, ids=None, levels=None, xp=None, last_award=None):
+        self.ids = ids if ids is not None else array('Q')
+        self.levels = levels if levels is not None else array('I')
+        self.xp = xp if xp is not None else array('I')
+        self.last_award = last_award if last_award is not None else array('I')
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, user_id):
+        return self._find(user_id) >= 0
+
+    def _find(self, user_id):
+        ids = self.ids
+        row = bisect_left(ids, user_id)
+        if row < len(ids) and ids[row] == user_id:
+            return row
+        return -1
+
+    def get(self, user_id):
+        """(level, total_xp) for a user, or None if they have no entry."""
+        row = self._find(user_id)
+        if row < 0:
+            return None
+        return self.levels[row], self.xp[row]
+
+    def last_award_of(self, user_id):
+        """Unix time of a user's last award, or None if they have no entry."""
+        row = self._find(user_id)
+        return self.last_award[row] if row >= 0 else None
+
+    def set(self, user_id, level, total_xp, last_award=None):
+        """Store a user's entry; a last_award of None keeps the old one, or is now for a new entry."""
+        ids = self.ids
+        row = bisect_left(ids, user_id)
+        if row < len(ids) and ids[row] == user_id:
+            self.levels[row] = level
+            self.xp[row] = total_xp
+            if last_award is not None:
+                self.last_award[row] = last_award
+        else:
+            ids.insert(row, user_id)
+            self.levels.insert(row, level)
+            self.xp.insert(row, total_xp)
+            self.last_award.insert(row, int(time.time()) if last_award is None else last_award)
+
+    def remove(self, user_id):
+        row = self._find(user_id)
+        if row >= 0:
+            del self.ids[row]
+            del self.levels[row]
+            del self.xp[row]
+            del self.last_award[row]
+
+    def remove_many(self, user_ids):
+        """Drop several users in one pass over the columns; returns their (user_id, level, total_xp, last_award)."""
+        if not self.ids or not user_ids:
+            return []
+        ids = np.frombuffer(self.ids, dtype=np.uint64)
+        drop = np.isin(ids, np.fromiter(user_ids, dtype=np.uint64, count=len(user_ids)))
+        if not drop.any():
+            return []
+        levels = np.frombuffer(self.levels, dtype=np.uint32)
+        xp = np.frombuffer(self.xp, dtype=np.uint32)
+        last_award = np.frombuffer(self.last_award, dtype=np.uint32)
+        removed = list(zip(ids[drop].tolist(), levels[drop].tolist(), xp[drop].tolist(), last_award[drop].tolist()))
+        keep = ~drop
+        self.ids = array('Q', ids[keep].tobytes())
+        self.levels = array('I', levels[keep].tobytes())
+        self.xp = array('I', xp[keep].tobytes())
+        self.last_award = array('I', last_award[keep].tobytes())
+        return removed
+
+    def inactive(self, before):
+        """IDs of the users whose last award came before the Unix time before."""
+        if not self.ids:
+            return []
+        last_award = np.frombuffer(self.last_award, dtype=np.uint32)
+        return np.frombuffer(self.ids, dtype=np.uint64)[last_award < before].tolist()
+
+    def items(self):
+        """Yield (user_id, level, total_xp) for every user, in user ID order."""
+        return zip(self.ids, self.levels, self.xp)
+
+    def recompute_levels(self, step=None):
+        """Re-derive every level from total XP in one vectorized pass; returns the IDs whose level changed."""
+        if not self.ids:
+            return []
+        old = np.frombuffer(self.levels, dtype=np.uint32)
+        new = levels_for_xp(np.frombuffer(self.xp, dtype=np.uint32), step)
+        changed = np.frombuffer(self.ids, dtype=np.uint64)[old != new].tolist()
+        self.levels = array('I', new.tobytes())
+        return changed
+
+    # JSON form, as stored in db.json and shown to humans
+    @classmethod
+    def from_json(cls, users):
+        table = cls()
+        # Entries saved before award times were kept count as active from now on
+        now = int(time.time())
+        for user_id in sorted(users, key=int):
+            entry = users[user_id]
+            total_xp = total_xp_of(entry)
+            table.ids.append(int(user_id))
+            table.levels.append(level_for_xp(total_xp))
+            table.xp.append(total_xp)
+            table.last_award.append(entry.get('last_award', now))
+        return table
+
+    def to_json(self):
+        return {str(user_id): {"level": level, "total_xp": total_xp, "last_award": last_award}
+                for user_id, level, total_xp, last_award in zip(self.ids, self.levels, self.xp, self.last_award)}
+
+    # Binary form
+    def to_bytes(self):
+        columns = [self.ids, self.levels, self.xp, self.last_award]
+        if sys.byteorder != 'little':
+            columns = [array(column.typecode, column) for column in columns]
+            for column in columns:
+                column.byteswap()
+        return b''.join(column.tobytes() for column in columns)
+
+    @classmethod
+    def from_buffer(cls, buffer, offset, count, version=SNAPSHOT_VERSION):
+        """Read a table of count users starting at offset; returns (table, end offset)."""
+        columns = []
+        for typecode in ('Q', 'I', 'I', 'I') if version >= 3 else ('Q', 'I', 'I'):
+            column = array(typecode)
+            size = column.itemsize * count
+            column.frombytes(buffer[offset:offset + size])
+            if sys.byteorder != 'little':
+                column.byteswap()
+            columns.append(column)
+            offset += size
+        if version < 3:
+            # Older snapshots have no award times; count everyone as active from now on
+            columns.append(array('I', [int(time.time())]) * count)
+        return cls(*columns), offset
+
+def levels_to_json(levels):
+    """JSON-ready copy of a {guild_id: LevelTable} mapping."""
+    return {guild_id: table.to_json() for guild_id, table in levels.items()}
+
+def levels_from_json(levels):
+    return {guild_id: LevelTable.from_json(users) for guild_id, users in levels.items()}
+
+def encode_snapshot(levels):
+    """Binary snapshot of a {guild_id: LevelTable} mapping."""
+    parts = [HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, len(levels))]
+    for guild_id, table in levels.items():
+        parts.append(GUILD_HEADER.pack(int(guild_id), len(table)))
+        parts.append(table.to_bytes())
+    return b''.join(parts)
+
+def read_snapshot(path):
+    """Load a binary snapshot through a memory map; returns {guild_id: LevelTable}."""
+    levels = {}
+    if not os.path.exists(path) or os.path.getsize(path) == 0:
+        return levels
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+        magic, version, guild_count = HEADER.unpack_from(buffer, 0)
+        if magic != SNAPSHOT_MAGIC or version not in (1, 2, SNAPSHOT_VERSION):
+            raise ValueError(f"{path} is not a level snapshot")
+        offset = HEADER.size
+        for _ in range(guild_count):
+            guild_id, count = GUILD_HEADER.unpack_from(buffer, offset)
+            table, offset = LevelTable.from_buffer(buffer, offset + GUILD_HEADER.size, count, version)
+            if version == 1:
+                # Old snapshots hold XP since the last level-up; turn it into total XP
+                table.xp = array('I', [xp_for_level(level) + xp for level, xp in zip(table.levels, table.xp)])
+            levels[str(guild_id)] = table
+    return levels
+
+if __name__ == '__main__':
+    # Human-readable export: python -m util.leveltable db.levels.bin
+    print(json.dumps(levels_to_json(read_snapshot(sys.argv[1])), indent=4))
@@ -0,0 +1,71 @@
+#***************************************************************************#
+# Underground Grotto
+#***************************************************************************#
+
+import time
+
+from util.quotes import new_quote
+
+class QuoteImport:
+    """Saves the pinned messages and/or the history of a channel as quotes.
+
+    Messages are streamed, pins first and then history oldest first, and
+    go through the same checks as Save as Quote, so anything already
+    saved is skipped and running the import again only adds what is new.
+    Added quotes are written batch_size at a time with one storage save
+    instead of one write per message; only the current page of history
+    and the pending batch are held in memory.
+    """
+
+    def __init__(self, store, channel, saved_by, pins=True, history=False, batch_size=100, progress_interval=5.0):
+        self.store = store
+        self.channel = channel
+        self.saved_by = saved_by  # Member credited with saving the imported quotes
+        self.pins = pins
+        self.history = history
+        self.batch_size = batch_size
+        self.progress_interval = progress_interval
+        self.scanned = 0
+        self.added = 0
+        self.skipped = 0
+        self._batch = []  # Change keys of the quotes added since the last save
+        self._last_report = 0.0
+
+    def progress(self):
+        return f"{self.scanned} messages scanned, {self.added} quotes added, {self.skipped} skipped"
+
+    async def messages(self):
+        if self.pins:
+            async for pin in self.channel.pins(limit=None):
+                yield pin.message
+        if self.history:
+            async for message in self.channel.history(limit=None, oldest_first=True):
+                yield message
+
+    def _save_batch(self):
+        if self._batch:
+            self.store.storage.save(*self._batch)
+            self._batch = []
+
+    async def run(self, report):
+        """Import every message; report is a coroutine given progress text every progress_interval seconds."""
+        guild_id = self.channel.guild.id
+        try:
+            async for message in self.messages():
+                self.scanned += 1
+                if self.store.check_message(guild_id, message):
+                    self.skipped += 1
+                    continue
+                quote = new_quote(message.content, str(message.author), message.author.id,
+                                  str(self.saved_by), self.saved_by.id, self.channel.id, guild_id)
+                self._batch.append(('quotes', str(guild_id), self.store.add(quote, save=False)))
+                self.added += 1
+                if len(self._batch) >= self.batch_size:
+                    self._save_batch()
+                now = time.monotonic()
+                if now - self._last_report >= self.progress_interval:
+                    self._last_report = now
+                    await report(self.progress())
+        finally:
+            # Whatever was added before a failure still gets written
+            self._save_batch()
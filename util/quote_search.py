@@ -0,0 +1,223 @@
+#***************************************************************************#
+# Underground Grotto
+#***************************************************************************#
+
+import bisect
+import heapq
+import json
+import os
+import re
+
+from util.quotes import digest
+from util.storage import atomic_write
+
+# Inverted index of the quotes, kept so startup doesn't re-tokenize every quote
+INDEX_FILE = 'quotes_index.json'
+INDEX_VERSION = 2
+
+def log_path(path):
+    """The log of quotes indexed since the index at path was written."""
+    return path + '.log'
+
+TOKEN_RE = re.compile(r"\w+")
+# Longest token indexed; anything longer is cut down to this
+MAX_TOKEN = 32
+
+def tokenize(text):
+    """Lowercased word tokens of a text, in order, repeats included."""
+    return [token[:MAX_TOKEN] for token in TOKEN_RE.findall(text.casefold())]
+
+def intersect(smaller, larger):
+    """Positions of the sorted list smaller that are also in the sorted list larger.
+
+    A much longer list is probed with a binary search per candidate, so
+    the cost follows the shorter list; lists of similar length are
+    intersected as sets.
+    """
+    if len(larger) > 16 * len(smaller):
+        found = []
+        low = 0
+        for position in smaller:
+            # Both lists are sorted, so each search starts where the last one ended
+            low = bisect.bisect_left(larger, position, low)
+            if low == len(larger):
+                break
+            if larger[low] == position:
+                found.append(position)
+        return found
+    return sorted(set(smaller).intersection(larger))
+
+class GuildSearchIndex:
+    """One guild's postings, and the token count of each of its quotes by position."""
+
+    __slots__ = ('postings', 'lengths', 'last')
+
+    def __init__(self, postings=None, lengths=None, last=''):
+        self.postings = postings if postings is not None else {}  # Token -> positions of the quotes containing it
+        self.lengths = lengths if lengths is not None else []  # Position -> token count of the quote
+        self.last = last  # Digest of the last quote indexed, to tell whether a saved index matches the quotes
+
+    def add(self, position, quote):
+        tokens = tokenize(quote.get('content', ''))
+        for token in set(tokens):
+            self.postings.setdefault(token, []).append(position)
+        self.lengths.append(len(tokens))
+        self.last = digest(quote.get('content', '')).hex()
+
+    def matches(self, quotes):
+        """Whether these postings were built from the start of this quote list."""
+        count = len(self.lengths)
+        return count <= len(quotes) and (not count or digest(quotes[count - 1].get('content', '')).hex() == self.last)
+
+class QuoteSearchIndex:
+    """Per-guild inverted index from token to the positions of the quotes containing it.
+
+    Quotes are only ever appended, so each posting list stays sorted by
+    appending the new position. A query starts from the posting list of
+    its rarest term and only ever narrows it, binary-searching much longer
+    lists rather than reading them, so a query with one rare term stays
+    cheap however common the others are. Matches rank shorter quotes
+    first, where the terms make up more of the text, then newer ones.
+
+    On disk the index is a full dump plus a log of the quotes indexed
+    since, so saving costs the new quotes rather than the whole index.
+    The log is folded into a fresh dump when the index is loaded.
+    """
+
+    def __init__(self):
+        self.guilds = {}  # Guild ID (str) -> GuildSearchIndex
+        self.log = []  # JSON lines of the quotes indexed since the last save
+        self.rewrite = False  # Whether the index on disk can't be brought up to date by the log alone
+
+    @property
+    def dirty(self):
+        return self.rewrite or bool(self.log)
+
+    def add(self, guild_id, position, quote):
+        """Index the quote at position in the guild's list; positions must be added in order."""
+        index = self.guilds.get(guild_id)
+        if index is None:
+            index = self.guilds[guild_id] = GuildSearchIndex()
+        index.add(position, quote)
+        self.log.append(json.dumps({'guild': guild_id, 'position': position, 'content': quote.get('content', '')},
+                                   ensure_ascii=False))
+
+    def sync(self, quotes):
+        """Index the quotes added since the index was saved; a guild whose list doesn't match is rebuilt.
+
+        quotes is the storage's quote lists keyed by guild ID. Returns how many quotes were tokenized.
+        """
+        added = 0
+        for guild_id in set(self.guilds) - set(quotes):
+            del self.guilds[guild_id]
+            self.rewrite = True
+        for guild_id, guild_quotes in quotes.items():
+            index = self.guilds.get(guild_id)
+            if index is None or not index.matches(guild_quotes):
+                if index is not None:
+                    self.rewrite = True
+                index = self.guilds[guild_id] = GuildSearchIndex()
+            for position in range(len(index.lengths), len(guild_quotes)):
+                self.add(guild_id, position, guild_quotes[position])
+                added += 1
+        return added
+
+    def search(self, guild_id, query, start=0, count=10):
+        """(total matches, positions of the ranked matches from start to start + count).
+
+        Every term of the query has to appear in a quote for it to match.
+        """
+        terms = set(tokenize(query))
+        index = self.guilds.get(str(guild_id))
+        if not terms or index is None:
+            return 0, []
+        lists = sorted((index.postings.get(term, ()) for term in terms), key=len)
+        if not lists[0]:
+            return 0, []
+        matches = lists[0]
+        for positions in lists[1:]:
+            matches = intersect(matches, positions)
+            if not matches:
+                return 0, []
+        # Shorter first, then newer, folded into one int so the heap compares plain ints
+        lengths = index.lengths
+        newest = len(lengths)
+        ranked = heapq.nsmallest(start + count, matches, key=lambda position: lengths[position] * newest - position)
+        return len(matches), ranked[start:]
+
+    @classmethod
+    def load(cls, path=INDEX_FILE):
+        """Index saved at path with its log replayed; an empty one if it is missing, unreadable or from another version.
+
+        rewrite is set whenever the dump should be written again, e.g. to fold the log in.
+        """
+        index = cls()
+        index.rewrite = True
+        if not os.path.exists(path):
+            return index
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                saved = json.load(f)
+        except ValueError as e:
+            print(f"Error reading {path}, rebuilding the quote search index: {e}")
+            return index
+        if saved.get('version') != INDEX_VERSION:
+            return index
+        index.guilds = {guild_id: GuildSearchIndex(**guild) for guild_id, guild in saved['guilds'].items()}
+        index.rewrite = index.replay(log_path(path)) > 0
+        return index
+
+    def replay(self, path):
+        """Index the quotes recorded in the log at path; returns how many lines it had."""
+        if not os.path.exists(path):
+            return 0
+        lines = 0
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                lines += 1
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # A crash mid-append leaves a torn line; sync() indexes whatever it held from the quotes
+                    print(f"Dropping damaged record in {path}")
+                    break
+                index = self.guilds.get(record['guild'])
+                count = len(index.lengths) if index is not None else 0
+                if record['position'] < count:
+                    # Already in the dump (a crash came after writing it but before emptying the log)
+                    continue
+                if record['position'] > count:
+                    break
+                if index is None:
+                    index = self.guilds[record['guild']] = GuildSearchIndex()
+                index.add(record['position'], record)
+        return lines
+
+    def encode(self):
+        """The whole index as JSON text for save(); run on the event loop so the index can't change mid-dump."""
+        self.rewrite = False
+        self.log = []
+        guilds = {guild_id: {'postings': index.postings, 'lengths': index.lengths, 'last': index.last}
+                  for guild_id, index in self.guilds.items()}
+        return json.dumps({'version': INDEX_VERSION, 'guilds': guilds}, ensure_ascii=False, separators=(',', ':'))
+
+    def take_log(self):
+        """The log lines of the quotes indexed since the last save, for append()."""
+        text = ''.join(line + '\n' for line in self.log)
+        self.log = []
+        return text
+
+    @staticmethod
+    def save(text, path=INDEX_FILE):
+        """Write a whole index from encode(); the log it replaces starts over."""
+        atomic_write(path, text)
+        with open(log_path(path), 'w', encoding='utf-8'):
+            pass
+
+    @staticmethod
+    def append(text, path=INDEX_FILE):
+        """Add lines from take_log() to the log of the index at path."""
+        with open(log_path(path), 'a', encoding='utf-8') as f:
+            f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
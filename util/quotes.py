@@ -0,0 +1,106 @@
+#***************************************************************************#
+# Underground Grotto
+#***************************************************************************#
+
+import hashlib
+import random
+
+def digest(content):
+    """Short fixed-size fingerprint of a quote's text for duplicate checks."""
+    return hashlib.blake2b(content.encode('utf-8'), digest_size=16).digest()
+
+def payload_author(author):
+    """str() of a user, from the raw user payload of a resolved message."""
+    if author.get('discriminator', '0') == '0':
+        return author['username']
+    return f"{author['username']}#{author['discriminator']}"
+
+def new_quote(content, author, author_id, saved_by, saved_by_id, channel_id, guild_id):
+    """A quote entry in the shape stored in the quotes section."""
+    return {
+        'content': content,
+        'author': author,
+        'author_id': author_id,
+        'saved_by': saved_by,
+        'saved_by_id': saved_by_id,
+        'channel_id': channel_id,
+        'guild_id': guild_id
+    }
+
+class QuoteStore:
+    """The per-guild quote lists with positions indexed by author.
+
+    Quotes live in storage.quotes, loaded once at startup and keyed by
+    guild ID, so every lookup only touches the asking guild's list. The
+    author index holds positions into it, so a random quote for an author
+    is one random.choice over an index list and counts are a len().
+    Digests of each (guild, author)'s quote texts make duplicate checks
+    a set lookup. Quotes must be added through add() to keep the indexes
+    current.
+    """
+
+    def __init__(self, storage, search_index=None):
+        self.storage = storage
+        self.search_index = search_index  # QuoteSearchIndex told about every added quote, if any
+        self.by_author = {}  # (guild ID, author ID) -> positions of the author's quotes in the guild
+        self.digests = {}  # (guild ID, author ID) -> digests of the author's quote texts there
+        for guild_id, quotes in storage.quotes.items():
+            for position, quote in enumerate(quotes):
+                self._index(guild_id, position, quote)
+
+    def _index(self, guild_id, position, quote):
+        key = (guild_id, quote.get('author_id'))
+        self.by_author.setdefault(key, []).append(position)
+        self.digests.setdefault(key, set()).add(digest(quote.get('content', '')))
+
+    def quotes(self, guild_id):
+        """The guild's quotes in the order they were saved."""
+        return self.storage.quotes.get(str(guild_id), [])
+
+    def has(self, guild_id, author_id, content):
+        """Whether the author already has a quote with exactly this text in the guild."""
+        return digest(content) in self.digests.get((str(guild_id), author_id), ())
+
+    def check_message(self, guild_id, message):
+        """Why a message can't be saved as a quote in the guild, or None if it can."""
+        # Don't save empty messages or bot messages
+        if not message.content or message.author.bot:
+            return 'Cannot save this message as a quote!'
+        if self.has(guild_id, message.author.id, message.content):
+            return 'This quote has already been saved!'
+        return None
+
+    def add(self, quote, save=True):
+        """Append a quote to its guild's list, index it and schedule its write; returns its position.
+
+        With save False the caller saves ('quotes', guild_id, position) itself, e.g. for a batch.
+        """
+        guild_id = str(quote.get('guild_id'))
+        quotes = self.storage.quotes.setdefault(guild_id, [])
+        quotes.append(quote)
+        position = len(quotes) - 1
+        self._index(guild_id, position, quote)
+        if self.search_index is not None:
+            self.search_index.add(guild_id, position, quote)
+        if save:
+            self.storage.save(('quotes', guild_id, position))
+        return position
+
+    def count(self, guild_id, author_id=None):
+        """Number of the guild's quotes, or of one author's quotes there."""
+        if author_id is None:
+            return len(self.quotes(guild_id))
+        return len(self.by_author.get((str(guild_id), author_id), ()))
+
+    def random(self, guild_id, author_id=None):
+        """A random quote of the guild, or of one author there; None if there are none."""
+        quotes = self.quotes(guild_id)
+        if author_id is None:
+            return random.choice(quotes) if quotes else None
+        positions = self.by_author.get((str(guild_id), author_id))
+        return quotes[random.choice(positions)] if positions else None
+
+    def page(self, guild_id, start, count):
+        """(position, quote) for up to count of the guild's quotes starting at position start."""
+        # A slice copies only the page, however far into the list it starts
+        return list(enumerate(self.quotes(guild_id)[start:start + count], start))
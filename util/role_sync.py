@@ -0,0 +1,117 @@
+#***************************************************************************#
+# Underground Grotto
+#***************************************************************************#
+
+import asyncio
+import time
+from bisect import bisect_right
+
+import discord
+
+class LevelRoles:
+    """The configured level roles of one guild, ordered by required level.
+
+    desired(level) is a bisect into the thresholds, so each member's
+    target set is worked out once instead of once per configured role.
+    """
+
+    def __init__(self, guild, level_roles):
+        pairs = []
+        self.missing = []  # Configured role names that don't exist in the guild
+        for role_config in level_roles.values():
+            role = discord.utils.get(guild.roles, name=role_config.get('name', ''))
+            if role is None:
+                self.missing.append(role_config.get('name', ''))
+            else:
+                pairs.append((role_config.get('required_level', 0), role))
+        pairs.sort(key=lambda pair: pair[0])
+        self.thresholds = [required_level for required_level, role in pairs]
+        self.roles = [role for required_level, role in pairs]
+        self.managed = set(self.roles)
+
+    def __bool__(self):
+        return bool(self.roles)
+
+    def desired(self, level):
+        """Every level role a member at this level should hold."""
+        return set(self.roles[:bisect_right(self.thresholds, level)])
+
+    def diff(self, member, level):
+        """The member's full new role list, or None if their level roles are already right."""
+        current = set(member.roles)
+        desired = self.desired(level)
+        add = desired - current
+        remove = (current & self.managed) - desired
+        if not add and not remove:
+            return None
+        # Keep @everyone out of the list; Discord always adds it back
+        return [role for role in (current - remove) | add if not role.is_default()]
+
+class RoleSync:
+    """Brings every leveled member's level roles in line with their level.
+
+    Members are walked in user ID order in batches. Each member needing a
+    change gets one edit with their whole new role list, at most
+    concurrency edits are in flight at once (discord.py's HTTP client
+    waits out the per-guild member-edit bucket behind that), and the last
+    user ID of each finished batch is written to the checkpoint file so an
+    interrupted run can resume after it.
+    """
+
+    JOB = 'role_sync'
+
+    def __init__(self, guild, level_roles, checkpoints, concurrency=4, batch_size=50, progress_interval=5.0):
+        self.guild = guild
+        self.level_roles = level_roles
+        self.checkpoints = checkpoints
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.batch_size = batch_size
+        self.progress_interval = progress_interval  # Seconds between progress message edits
+        state = checkpoints.get(self.JOB, guild.id) or {}
+        self.resumed = bool(state)
+        self.after = state.get('after', -1)  # Last user ID already reconciled
+        self.checked = state.get('checked', 0)
+        self.changed = state.get('changed', 0)
+        self.failed = state.get('failed', 0)
+        self.total = 0
+
+    def progress(self):
+        return f"{self.checked}/{self.total} members checked, {self.changed} updated, {self.failed} failed"
+
+    async def _apply(self, member, roles):
+        async with self.semaphore:
+            try:
+                await member.edit(roles=roles, reason="Level role reconciliation")
+                self.changed += 1
+            except discord.HTTPException as e:
+                print(f"Error updating roles for {member}: {e}")
+                self.failed += 1
+
+    async def run(self, guild_levels, report=None):
+        """Reconcile every member in guild_levels; report(text) is awaited at most every progress_interval seconds."""
+        rows = [(user_id, level) for user_id, level, total_xp in guild_levels.items()]
+        self.total = len(rows)
+        # Skip the members a previous run already finished
+        start = bisect_right(rows, (self.after, float('inf')))
+        last_report = time.monotonic()
+
+        for offset in range(start, len(rows), self.batch_size):
+            batch = rows[offset:offset + self.batch_size]
+            edits = []
+            for user_id, level in batch:
+                member = self.guild.get_member(user_id)
+                roles = member and self.level_roles.diff(member, level)
+                if roles is not None:
+                    edits.append(self._apply(member, roles))
+            await asyncio.gather(*edits)
+
+            self.checked = offset + len(batch)
+            self.after = batch[-1][0]
+            self.checkpoints.set(self.JOB, self.guild.id, {
+                'after': self.after, 'checked': self.checked, 'changed': self.changed, 'failed': self.failed})
+            if report and time.monotonic() - last_report >= self.progress_interval:
+                last_report = time.monotonic()
+                await report(self.progress())
+
+        self.checked = self.total
+        self.checkpoints.clear(self.JOB, self.guild.id)
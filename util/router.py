@@ -0,0 +1,65 @@
+#***************************************************************************#
+# Underground Grotto
+#***************************************************************************#
+
+import time
+
+import discord
+
+# Discord's limit on a component's custom_id
+MAX_CUSTOM_ID = 100
+
+class ComponentRouter:
+    """Dispatches button, select and modal interactions by the prefix of their custom_id.
+
+    A prompt's whole state lives in its custom_id, "prefix:expires:arg:...",
+    so a handler needs nothing kept in memory and keeps working for
+    prompts sent before a restart. Each interaction costs one dict lookup
+    no matter how many prompts are open. Views sent with these IDs should
+    be created with store=False so discord.py doesn't also track them.
+    """
+
+    def __init__(self):
+        self.routes = {}  # Prefix -> coroutine handler(interaction, *args)
+
+    def add(self, prefix, handler):
+        if ':' in prefix:
+            raise ValueError(f"Route prefix '{prefix}' can't contain ':'")
+        self.routes[prefix] = handler
+
+    def remove(self, prefix):
+        self.routes.pop(prefix, None)
+
+    @staticmethod
+    def custom_id(prefix, *args, timeout=None):
+        """Encode a route and its arguments; the prompt stops working timeout seconds from now."""
+        expires = int(time.time() + timeout) if timeout else 0
+        custom_id = ':'.join([prefix, str(expires), *map(str, args)])
+        if len(custom_id) > MAX_CUSTOM_ID:
+            raise ValueError(f"custom_id '{custom_id}' is longer than {MAX_CUSTOM_ID} characters")
+        return custom_id
+
+    async def dispatch(self, interaction):
+        """on_interaction listener; interactions whose prefix has no route are left to discord.py."""
+        if interaction.type not in (discord.InteractionType.component, discord.InteractionType.modal_submit):
+            return
+        prefix, _, rest = (interaction.custom_id or '').partition(':')
+        handler = self.routes.get(prefix)
+        if handler is None or not rest:
+            return
+        expires, *args = rest.split(':')
+        if expires != '0' and time.time() > int(expires):
+            await self.expired(interaction)
+            return
+        try:
+            await handler(interaction, *args)
+        except Exception as e:
+            print(f"Error handling '{prefix}' interaction: {e}")
+
+    async def expired(self, interaction):
+        # Take the stale controls off the message so nobody else tries them
+        if interaction.type == discord.InteractionType.component:
+            await interaction.response.edit_message(view=None)
+            await interaction.followup.send("This prompt has expired; run the command again.", ephemeral=True)
+        else:
+            await interaction.response.send_message("This prompt has expired; run the command again.", ephemeral=True)
@@ -0,0 +1,95 @@
+#***************************************************************************#
+# Underground Grotto
+#***************************************************************************#
+
+import asyncio
+import heapq
+import itertools
+import time
+from datetime import datetime, timedelta
+
+import pytz
+
+# Longest single sleep; the due time is re-read after it so clock jumps and suspends are noticed
+MAX_SLEEP = 300
+
+def local_midnight(day, tz):
+    """Aware datetime of the start of day in tz, even on days a DST change skips or repeats midnight."""
+    naive = datetime.combine(day, datetime.min.time())
+    try:
+        return tz.localize(naive, is_dst=None)
+    except pytz.AmbiguousTimeError:
+        # Midnight happens twice; the first one starts the day
+        return tz.localize(naive, is_dst=True)
+    except pytz.NonExistentTimeError:
+        # Midnight is skipped; the day starts at the first wall-clock time after the gap
+        return tz.normalize(tz.localize(naive, is_dst=False))
+
+def next_local_midnight(tz, now=None):
+    """(date, aware datetime) of the next midnight in tz after now."""
+    now = now or datetime.now(pytz.utc)
+    tomorrow = now.astimezone(tz).date() + timedelta(days=1)
+    return tomorrow, local_midnight(tomorrow, tz)
+
+class Scheduler:
+    """Runs coroutine callbacks at wall-clock times.
+
+    Jobs sit in a min-heap keyed by due time and a single task sleeps
+    until the earliest one, so the cost is one wakeup per job rather than
+    a poll per job. Scheduling an earlier job wakes the task early; jobs
+    whose time has already passed run right away, in due order.
+    """
+
+    def __init__(self):
+        self._heap = []  # [timestamp, sequence, callback, args]
+        self._sequence = itertools.count()  # Keeps jobs due at the same time in scheduling order
+        self._wakeup = None
+        self._runner = None
+
+    def __len__(self):
+        return sum(1 for job in self._heap if job[2] is not None)
+
+    def schedule(self, when, callback, *args):
+        """Run await callback(*args) at the aware datetime when; returns a job handle for cancel()."""
+        if self._runner is None:
+            self._wakeup = asyncio.Event()
+            self._runner = asyncio.get_running_loop().create_task(self._run())
+        job = [when.timestamp(), next(self._sequence), callback, args]
+        heapq.heappush(self._heap, job)
+        if self._heap[0] is job:
+            self._wakeup.set()
+        return job
+
+    def cancel(self, job):
+        # Cancelled jobs stay in the heap and are skipped when they come due
+        job[2] = None
+
+    async def _run(self):
+        while True:
+            if not self._heap:
+                await self._wakeup.wait()
+                self._wakeup.clear()
+                continue
+            delay = self._heap[0][0] - time.time()
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), min(delay, MAX_SLEEP))
+                except asyncio.TimeoutError:
+                    pass
+                self._wakeup.clear()
+                continue
+            timestamp, _, callback, args = heapq.heappop(self._heap)
+            if callback is not None:
+                # Jobs run as their own tasks so a slow one can't hold up the rest
+                asyncio.get_running_loop().create_task(self._call(callback, args))
+
+    async def _call(self, callback, args):
+        try:
+            await callback(*args)
+        except Exception as e:
+            print(f"Error in scheduled job {getattr(callback, '__name__', callback)}: {e}")
+
+    def close(self):
+        if self._runner is not None:
+            self._runner.cancel()
+            self._runner = None
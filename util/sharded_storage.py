@@ -0,0 +1,124 @@
+#***************************************************************************#
+# Underground Grotto
+#***************************************************************************#
+
+import json
+import os
+
+from util.leveltable import LevelTable, encode_snapshot, levels_from_json, read_snapshot
+from util.storage import default_db, atomic_write, quotes_by_guild
+
+class ShardedBackend:
+    """Stores each guild's data in its own directory so a write only touches the guilds that changed.
+
+    Layout under the data directory:
+        global.json                birthdays and friend codes
+        <guild_id>/levels.json     that guild's level data, read on first use
+                                   (levels.bin with the binary snapshot format)
+        <guild_id>/quotes.json     that guild's quotes
+        <guild_id>/birthdays.json  that guild's birthday settings and opted-in members
+    """
+
+    executor = None  # Commits run on the event loop's default thread pool
+    lazy = True  # Level partitions are read by load_guild() when first needed
+
+    def __init__(self, path='data', import_from=None, binary=False):
+        self.path = path
+        self.import_from = import_from  # db.json to split up on first start
+        self.binary = binary
+
+    def _file(self, *parts):
+        return os.path.join(self.path, *parts)
+
+    def _read(self, path, default):
+        if not os.path.exists(path):
+            return default
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def load(self):
+        if not os.path.isdir(self.path) and self.import_from and os.path.exists(self.import_from):
+            self.import_json(self.import_from)
+
+        data = default_db()
+        data.update(self._read(self._file('global.json'), {}))
+        # Quotes and birthday settings are small next to the level tables, so every guild's are read up front
+        if os.path.isdir(self.path):
+            for guild_id in sorted(os.listdir(self.path)):
+                quotes = self._read(self._file(guild_id, 'quotes.json'), None)
+                if quotes is not None:
+                    data['quotes'][guild_id] = quotes
+                birthday_settings = self._read(self._file(guild_id, 'birthdays.json'), None)
+                if birthday_settings is not None:
+                    data['birthday_guilds'][guild_id] = birthday_settings
+        return data
+
+    def load_guild(self, guild_id):
+        # Either form is read, so switching formats carries the data over. Writing one
+        # form deletes the other, but if both are left the newer one holds the latest data
+        binary_path = self._file(guild_id, 'levels.bin')
+        json_path = self._file(guild_id, 'levels.json')
+        if os.path.exists(binary_path) and (not os.path.exists(json_path)
+                                            or os.path.getmtime(binary_path) >= os.path.getmtime(json_path)):
+            return read_snapshot(binary_path).get(guild_id, LevelTable())
+        return LevelTable.from_json(self._read(json_path, {}))
+
+    def import_json(self, path):
+        """One-shot split of an existing db.json into per-guild files."""
+        with open(path, 'r', encoding='utf-8') as f:
+            data = default_db()
+            data.update(json.load(f))
+        data['levels'] = levels_from_json(data['levels'])
+        if isinstance(data['quotes'], list):
+            data['quotes'] = quotes_by_guild(data['quotes'])
+        os.makedirs(self.path, exist_ok=True)
+        self.commit(self.prepare(data, None))
+        print(f"Split {path} into per-guild files under {self.path}")
+
+    def prepare(self, data, changes):
+        """Encode every partition touched by the changes (all partitions when changes is None)."""
+        if changes is None:
+            level_guilds = set(data['levels'])
+            quote_guilds = set(data['quotes'])
+            birthday_guilds = set(data['birthday_guilds'])
+            write_global = True
+        else:
+            level_guilds = {key[1] for key in changes if key[0] == 'levels'}
+            quote_guilds = {key[1] for key in changes if key[0] == 'quotes'}
+            birthday_guilds = {key[1] for key in changes if key[0] == 'birthday_guilds'}
+            write_global = any(key[0] in ('birthdays', 'friend_codes') for key in changes)
+
+        files = {}
+        for guild_id in level_guilds:
+            table = data['levels'].get(guild_id)
+            if table is None:
+                continue
+            # None deletes the other form's file, so a stale copy can't be read back after switching formats
+            if self.binary:
+                files[self._file(guild_id, 'levels.bin')] = encode_snapshot({guild_id: table})
+                files[self._file(guild_id, 'levels.json')] = None
+            else:
+                files[self._file(guild_id, 'levels.json')] = json.dumps(table.to_json(), ensure_ascii=False, indent=4)
+                files[self._file(guild_id, 'levels.bin')] = None
+        for guild_id in quote_guilds:
+            files[self._file(guild_id, 'quotes.json')] = json.dumps(data['quotes'][guild_id], ensure_ascii=False, indent=4)
+        for guild_id in birthday_guilds:
+            birthday_settings = data['birthday_guilds'].get(guild_id)
+            # None deletes the file of a guild whose settings were removed
+            files[self._file(guild_id, 'birthdays.json')] = birthday_settings and json.dumps(birthday_settings, ensure_ascii=False, indent=4)
+        if write_global:
+            files[self._file('global.json')] = json.dumps(
+                {'birthdays': data['birthdays'], 'friend_codes': data['friend_codes']}, ensure_ascii=False, indent=4)
+        return files
+
+    def commit(self, files):
+        for path, text in files.items():
+            if text is None:
+                if os.path.exists(path):
+                    os.remove(path)
+                continue
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            atomic_write(path, text)
+
+    def close(self):
+        pass
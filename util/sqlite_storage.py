@@ -0,0 +1,240 @@
+#***************************************************************************#
+# Underground Grotto
+#***************************************************************************#
+
+import json
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from util.leveltable import LevelTable, levels_from_json, xp_for_level
+from util.storage import default_db, quotes_by_guild
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS levels (
+    guild_id INTEGER NOT NULL,
+    user_id INTEGER NOT NULL,
+    level INTEGER NOT NULL,
+    xp INTEGER NOT NULL, -- Total XP
+    last_award INTEGER NOT NULL DEFAULT 0, -- Unix time of the user's last award
+    PRIMARY KEY (guild_id, user_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS levels_by_rank ON levels (guild_id, xp DESC);
+
+CREATE TABLE IF NOT EXISTS guild_quotes (
+    guild_id INTEGER NOT NULL,
+    position INTEGER NOT NULL, -- Index in the guild's quote list
+    author_id INTEGER,
+    data TEXT NOT NULL,
+    PRIMARY KEY (guild_id, position)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS guild_quotes_by_author ON guild_quotes (guild_id, author_id);
+
+CREATE TABLE IF NOT EXISTS birthdays (
+    user_id INTEGER PRIMARY KEY,
+    month INTEGER NOT NULL,
+    day INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS birthdays_by_date ON birthdays (month, day);
+
+CREATE TABLE IF NOT EXISTS birthday_guilds (
+    guild_id INTEGER PRIMARY KEY,
+    data TEXT NOT NULL -- Channel, role and opted-in members as JSON
+);
+
+CREATE TABLE IF NOT EXISTS friend_codes (
+    user_id TEXT PRIMARY KEY,
+    data TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+def birthday_columns(birthday):
+    # Birthdays are kept in memory as "YYYY-MM-DD" strings
+    _, month, day = birthday.split('-')
+    return int(month), int(day)
+
+class SqliteBackend:
+    """Stores the database in SQLite (WAL mode) so a change is a row upsert, not a file rewrite.
+
+    Every thread of the small pool gets its own connection; writes are
+    serialized by the Storage writer and batched into one transaction.
+    """
+
+    lazy = False  # Every guild is loaded up front
+
+    def __init__(self, path='db.sqlite3', import_from=None, workers=2):
+        self.path = path
+        self.import_from = import_from  # db.json to migrate on first start
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='sqlite')
+        self._local = threading.local()
+        self._connections = []
+        self._connections_lock = threading.Lock()
+
+    def connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.executescript(SCHEMA)
+            self._local.conn = conn
+            with self._connections_lock:
+                self._connections.append(conn)
+        return conn
+
+    def load(self):
+        conn = self.connect()
+        self.migrate_last_award(conn)
+        migrated = conn.execute("SELECT value FROM meta WHERE key = 'imported_json'").fetchone()
+        if not migrated and self.import_from and os.path.exists(self.import_from):
+            self.import_json(self.import_from)
+        self.migrate_total_xp(conn)
+        self.migrate_guild_quotes(conn)
+
+        data = default_db()
+        for guild_id, user_id, level, xp, last_award in conn.execute(
+                'SELECT guild_id, user_id, level, xp, last_award FROM levels ORDER BY guild_id, user_id'):
+            table = data['levels'].get(str(guild_id))
+            if table is None:
+                table = data['levels'][str(guild_id)] = LevelTable()
+            # Rows arrive in user ID order, so they can go straight onto the columns
+            table.ids.append(user_id)
+            table.levels.append(level)
+            table.xp.append(xp)
+            table.last_award.append(last_award)
+        for guild_id, quote in conn.execute('SELECT guild_id, data FROM guild_quotes ORDER BY guild_id, position'):
+            data['quotes'].setdefault(str(guild_id), []).append(json.loads(quote))
+        for user_id, month, day in conn.execute('SELECT user_id, month, day FROM birthdays'):
+            data['birthdays'][str(user_id)] = f"2023-{month:02}-{day:02}"
+        for guild_id, value in conn.execute('SELECT guild_id, data FROM birthday_guilds'):
+            data['birthday_guilds'][str(guild_id)] = json.loads(value)
+        for user_id, value in conn.execute('SELECT user_id, data FROM friend_codes'):
+            data['friend_codes'][user_id] = json.loads(value)
+        return data
+
+    def migrate_total_xp(self, conn):
+        """Convert rows that still hold XP since the last level-up into total XP."""
+        if conn.execute("SELECT value FROM meta WHERE key = 'xp_model'").fetchone():
+            return
+        with conn:
+            conn.execute('DROP INDEX IF EXISTS levels_by_rank')
+            conn.execute('CREATE INDEX levels_by_rank ON levels (guild_id, xp DESC)')
+            rows = conn.execute('SELECT guild_id, user_id, level, xp FROM levels').fetchall()
+            conn.executemany('UPDATE levels SET xp = ? WHERE guild_id = ? AND user_id = ?',
+                             [(xp_for_level(level) + xp, guild_id, user_id) for guild_id, user_id, level, xp in rows])
+            conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('xp_model', 'total')")
+
+    def migrate_guild_quotes(self, conn):
+        """Move rows of the old quotes table, numbered across every guild, into per-guild positions."""
+        if not conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'quotes'").fetchone():
+            return
+        quotes = [json.loads(quote) for (quote,) in conn.execute('SELECT data FROM quotes ORDER BY id')]
+        rows = [(int(guild_id), position, quote.get('author_id'), json.dumps(quote, ensure_ascii=False))
+                for guild_id, guild_quotes in quotes_by_guild(quotes).items() for position, quote in enumerate(guild_quotes)]
+        with conn:
+            conn.executemany('INSERT OR REPLACE INTO guild_quotes (guild_id, position, author_id, data) VALUES (?, ?, ?, ?)', rows)
+            conn.execute('DROP TABLE quotes')
+        print(f"Moved {len(rows)} quotes into per-guild positions")
+
+    def migrate_last_award(self, conn):
+        """Add the last award column to an older levels table, counting everyone as active from now on."""
+        if any(column[1] == 'last_award' for column in conn.execute('PRAGMA table_info(levels)')):
+            return
+        with conn:
+            conn.execute('ALTER TABLE levels ADD COLUMN last_award INTEGER NOT NULL DEFAULT 0')
+            conn.execute('UPDATE levels SET last_award = ?', (int(time.time()),))
+
+    def import_json(self, path):
+        """One-shot migration of an existing db.json into the database."""
+        with open(path, 'r', encoding='utf-8') as f:
+            data = default_db()
+            data.update(json.load(f))
+        data['levels'] = levels_from_json(data['levels'])
+        if isinstance(data['quotes'], list):
+            data['quotes'] = quotes_by_guild(data['quotes'])
+        conn = self.connect()
+        with conn:
+            conn.execute('DELETE FROM levels')
+            conn.execute('DELETE FROM guild_quotes')
+            conn.execute('DELETE FROM birthdays')
+            conn.execute('DELETE FROM birthday_guilds')
+            conn.execute('DELETE FROM friend_codes')
+            self._write_rows(conn, self.prepare(data, None))
+            conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('imported_json', ?)", (os.path.abspath(path),))
+            conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('xp_model', 'total')")
+        print(f"Imported {path} into {self.path}")
+
+    def prepare(self, data, changes):
+        """Collect the rows to upsert for the changed keys (all rows when changes is None)."""
+        rows = {'levels': [], 'quotes': [], 'birthdays': [], 'birthday_guilds': [], 'friend_codes': [],
+                'removed_levels': [], 'removed_birthdays': [], 'removed_birthday_guilds': []}
+        if changes is None:
+            changes = [('levels', guild_id, user_id) for guild_id, table in data['levels'].items() for user_id in table.ids]
+            changes += [('quotes', guild_id, index) for guild_id, quotes in data['quotes'].items() for index in range(len(quotes))]
+            changes += [('birthdays', user_id) for user_id in data['birthdays']]
+            changes += [('birthday_guilds', guild_id) for guild_id in data['birthday_guilds']]
+            changes += [('friend_codes', user_id) for user_id in data['friend_codes']]
+
+        for section, *key in changes:
+            if section == 'levels':
+                guild_id, user_id = key
+                table = data['levels'].get(guild_id)
+                entry = table.get(user_id) if table is not None else None
+                if entry is not None:
+                    rows['levels'].append((int(guild_id), user_id, *entry, table.last_award_of(user_id)))
+                else:
+                    rows['removed_levels'].append((int(guild_id), user_id))
+            elif section == 'quotes':
+                guild_id, index = key
+                quote = data['quotes'][guild_id][index]
+                rows['quotes'].append((int(guild_id), index, quote.get('author_id'), json.dumps(quote, ensure_ascii=False)))
+            elif section == 'birthdays':
+                birthday = data['birthdays'].get(key[0])
+                if birthday is not None:
+                    rows['birthdays'].append((int(key[0]), *birthday_columns(birthday)))
+                else:
+                    rows['removed_birthdays'].append((int(key[0]),))
+            elif section == 'birthday_guilds':
+                settings = data['birthday_guilds'].get(key[0])
+                if settings is not None:
+                    rows['birthday_guilds'].append((int(key[0]), json.dumps(settings, ensure_ascii=False)))
+                else:
+                    rows['removed_birthday_guilds'].append((int(key[0]),))
+            elif section == 'friend_codes':
+                value = data['friend_codes'].get(key[0])
+                if value is not None:
+                    rows['friend_codes'].append((key[0], json.dumps(value, ensure_ascii=False)))
+        return rows
+
+    def _write_rows(self, conn, rows):
+        conn.executemany(
+            'INSERT INTO levels (guild_id, user_id, level, xp, last_award) VALUES (?, ?, ?, ?, ?) '
+            'ON CONFLICT (guild_id, user_id) DO UPDATE SET level = excluded.level, xp = excluded.xp, '
+            'last_award = excluded.last_award',
+            rows['levels'])
+        conn.executemany('INSERT OR REPLACE INTO guild_quotes (guild_id, position, author_id, data) VALUES (?, ?, ?, ?)', rows['quotes'])
+        conn.executemany('INSERT OR REPLACE INTO birthdays (user_id, month, day) VALUES (?, ?, ?)', rows['birthdays'])
+        conn.executemany('INSERT OR REPLACE INTO birthday_guilds (guild_id, data) VALUES (?, ?)', rows['birthday_guilds'])
+        conn.executemany('INSERT OR REPLACE INTO friend_codes (user_id, data) VALUES (?, ?)', rows['friend_codes'])
+        conn.executemany('DELETE FROM levels WHERE guild_id = ? AND user_id = ?', rows['removed_levels'])
+        conn.executemany('DELETE FROM birthdays WHERE user_id = ?', rows['removed_birthdays'])
+        conn.executemany('DELETE FROM birthday_guilds WHERE guild_id = ?', rows['removed_birthday_guilds'])
+
+    def commit(self, rows):
+        conn = self.connect()
+        with conn:  # One transaction per batch
+            self._write_rows(conn, rows)
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        with self._connections_lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections.clear()
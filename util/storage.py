@@ -0,0 +1,274 @@
+#***************************************************************************#
+# Underground Grotto
+#***************************************************************************#
+
+import asyncio
+import json
+import os
+import tempfile
+import time
+
+from util.leveltable import LevelTable, levels_from_json, levels_to_json, read_snapshot, encode_snapshot
+
+# Unified database file shared by every cog
+DB_FILE = 'db.json'
+# Binary snapshot of the level tables, used when levels_snapshot_format is "binary"
+LEVELS_FILE = 'db.levels.bin'
+# Longest wait between retries of a failing database write
+MAX_RETRY_DELAY = 60.0
+
+def default_db():
+    return {"quotes": {}, "birthdays": {}, "levels": {}, "friend_codes": {}, "birthday_guilds": {}}
+
+def quotes_by_guild(quotes):
+    """Split the old single list of every guild's quotes into per-guild lists, keeping their order."""
+    guilds = {}
+    for quote in quotes:
+        guilds.setdefault(str(quote.get('guild_id')), []).append(quote)
+    return guilds
+
+def atomic_write(path, content):
+    """Replace path with content (str or bytes) without ever leaving a truncated file behind."""
+    # Write to a temp file in the same directory and rename it over the old one
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(prefix='.db-', suffix='.tmp', dir=directory)
+    try:
+        if isinstance(content, bytes):
+            f = os.fdopen(fd, 'wb')
+        else:
+            f = os.fdopen(fd, 'w', encoding='utf-8')
+        with f:
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+class JsonBackend:
+    """Keeps the whole database in one JSON document on disk.
+
+    With binary set, level tables go to the snapshot at levels_path
+    instead of the "levels" section of the document.
+    """
+
+    executor = None  # Commits run on the event loop's default thread pool
+    lazy = False  # Every guild is loaded up front
+
+    def __init__(self, path=DB_FILE, levels_path=LEVELS_FILE, binary=False):
+        self.path = path
+        self.levels_path = levels_path
+        self.binary = binary
+
+    def load(self):
+        data = default_db()
+        if os.path.exists(self.path):
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data.update(json.load(f))
+        # Whichever form holds the levels is used, so switching formats carries the data over
+        if not data['levels'] and os.path.exists(self.levels_path):
+            data['levels'] = read_snapshot(self.levels_path)
+        else:
+            data['levels'] = levels_from_json(data['levels'])
+        return data
+
+    def prepare(self, data, changes):
+        # The file is rewritten whole, so which entries changed doesn't matter.
+        # Encoding happens here, on the event loop, so the document can't
+        # change mid-dump; only the disk I/O is handed to a thread
+        document = dict(data)
+        if self.binary:
+            document['levels'] = {}
+            return json.dumps(document, ensure_ascii=False, indent=4), encode_snapshot(data['levels'])
+        document['levels'] = levels_to_json(data['levels'])
+        return json.dumps(document, ensure_ascii=False, indent=4), None
+
+    def commit(self, payload):
+        text, snapshot = payload
+        if snapshot is not None:
+            atomic_write(self.levels_path, snapshot)
+        atomic_write(self.path, text)
+        if snapshot is None and os.path.exists(self.levels_path):
+            # The levels are in the document now; drop the old snapshot so load() can't fall back to it later
+            os.remove(self.levels_path)
+
+    def close(self):
+        pass
+
+def create_backend(config):
+    """Build the storage backend selected by the storage_backend config key."""
+    name = config.get('storage_backend', 'json')
+    binary = config.get('levels_snapshot_format', 'json') == 'binary'
+    levels_path = config.get('levels_snapshot_file', LEVELS_FILE)
+    if name == 'json':
+        return JsonBackend(config.get('db_file', DB_FILE), levels_path, binary)
+    if name == 'sqlite':
+        from util.sqlite_storage import SqliteBackend
+        return SqliteBackend(config.get('sqlite_file', 'db.sqlite3'), import_from=config.get('db_file', DB_FILE))
+    if name == 'journal':
+        from util.journal_storage import JournalBackend
+        return JournalBackend(config.get('db_file', DB_FILE), config.get('journal_file', 'db.journal'), levels_path, binary,
+                              compact_bytes=config.get('journal_compact_bytes', 1024 * 1024))
+    if name == 'sharded':
+        from util.sharded_storage import ShardedBackend
+        return ShardedBackend(config.get('data_dir', 'data'), import_from=config.get('db_file', DB_FILE), binary=binary)
+    raise ValueError(f"Unknown storage_backend '{name}'")
+
+class Storage:
+    """Single in-memory copy of the bot database.
+
+    Cogs mutate the sections in place and call save() naming what they
+    changed, e.g. save(('levels', guild_id, user_id)). One writer task
+    coalesces those calls and hands them to the backend on a worker
+    thread, so the event loop never waits on the disk.
+
+    Level data is reached per guild through guild_levels(). With a lazy
+    backend a guild's partition is only read on first access and can be
+    dropped again by evict_idle() once nobody has used it for a while.
+    """
+
+    def __init__(self, backend=None, write_delay=1.0):
+        self.backend = backend or JsonBackend()
+        self.write_delay = write_delay  # Seconds to wait for more changes before writing
+        self.data = self.backend.load()
+        self._changes = set()
+        self._everything = False  # A save() without keys rewrites every section
+        if isinstance(self.data['quotes'], list):
+            # Quotes used to be one list across every guild; split it once and write the new layout
+            self.data['quotes'] = quotes_by_guild(self.data['quotes'])
+            self._everything = True
+        self._wakeup = None
+        self._writer = None
+        self._write_lock = None
+        self._last_used = {}  # Guild ID -> monotonic time of the last guild_levels() call
+        self._loading = {}  # Guild ID -> future of a partition being read
+
+    # Sections of the database
+    @property
+    def levels(self):
+        """LevelTable of every guild currently in memory, keyed by guild ID."""
+        return self.data['levels']
+
+    async def guild_levels(self, guild_id):
+        """LevelTable of one guild, reading its partition first if it isn't in memory."""
+        levels = self.data['levels']
+        if self.backend.lazy:
+            self._last_used[guild_id] = time.monotonic()
+            if guild_id not in levels:
+                await self._load_guild(guild_id)
+        return levels.setdefault(guild_id, LevelTable())
+
+    async def _load_guild(self, guild_id):
+        loading = self._loading.get(guild_id)
+        if loading is None:
+            # Concurrent callers share one read of the partition
+            loop = asyncio.get_running_loop()
+            loading = self._loading[guild_id] = loop.run_in_executor(self.backend.executor, self.backend.load_guild, guild_id)
+            loading.add_done_callback(lambda _: self._loading.pop(guild_id, None))
+        users = await asyncio.shield(loading)
+        self.data['levels'].setdefault(guild_id, users)
+
+    def evict_idle(self, max_idle):
+        """Drop level partitions unused for max_idle seconds that have nothing left to write.
+
+        Returns the IDs of the guilds that were dropped.
+        """
+        if not self.backend.lazy or self._everything:
+            return []
+        now = time.monotonic()
+        dirty = {key[1] for key in self._changes if key[0] == 'levels'}
+        evicted = []
+        for guild_id, last_used in list(self._last_used.items()):
+            if now - last_used >= max_idle and guild_id not in dirty:
+                self.data['levels'].pop(guild_id, None)
+                del self._last_used[guild_id]
+                evicted.append(guild_id)
+        return evicted
+
+    @property
+    def birthdays(self):
+        return self.data['birthdays']
+
+    @property
+    def birthday_guilds(self):
+        """Per-guild birthday settings and opted-in members, keyed by guild ID."""
+        return self.data['birthday_guilds']
+
+    @property
+    def quotes(self):
+        """Quote lists keyed by guild ID; a quote's number is its position in its guild's list."""
+        return self.data['quotes']
+
+    @property
+    def friend_codes(self):
+        return self.data['friend_codes']
+
+    def _start_writer(self):
+        self._wakeup = asyncio.Event()
+        self._write_lock = asyncio.Lock()
+        self._writer = asyncio.get_running_loop().create_task(self._write_loop())
+
+    def save(self, *changes):
+        """Schedule a write. Each change is a key tuple such as ('levels', guild_id, user_id),
+        ('birthdays', user_id), ('birthday_guilds', guild_id) or ('quotes', guild_id, index); with no
+        changes everything is written."""
+        if self._writer is None:
+            self._start_writer()
+        if changes:
+            self._changes.update(changes)
+        else:
+            self._everything = True
+        self._wakeup.set()
+
+    async def flush(self):
+        """Write pending changes now and wait for them to reach the disk."""
+        if self._write_lock is None:
+            self._write_lock = asyncio.Lock()
+        async with self._write_lock:
+            if not self._changes and not self._everything:
+                return
+            changes = None if self._everything else self._changes
+            self._changes = set()
+            self._everything = False
+            payload = self.backend.prepare(self.data, changes)
+            loop = asyncio.get_running_loop()
+            # Shielded so a cancelled caller can't abandon a half-finished write
+            inflight = loop.run_in_executor(self.backend.executor, self.backend.commit, payload)
+            # Its error is handled below, or dropped if the caller was cancelled; don't log it as unretrieved
+            inflight.add_done_callback(lambda future: future.cancelled() or future.exception())
+            try:
+                await asyncio.shield(inflight)
+            except BaseException:
+                # Keep the changes so the next flush retries them, even if the caller was cancelled mid-write
+                if changes is None:
+                    self._everything = True
+                else:
+                    self._changes.update(changes)
+                raise
+
+    async def _write_loop(self):
+        retry_delay = 0.0
+        while True:
+            await self._wakeup.wait()
+            await asyncio.sleep(max(self.write_delay, retry_delay))
+            self._wakeup.clear()
+            try:
+                await self.flush()
+                retry_delay = 0.0
+            except Exception as e:
+                # flush() kept the changes; wake up again to retry them, backing off while the disk keeps failing
+                retry_delay = min(max(retry_delay * 2, 1.0), MAX_RETRY_DELAY)
+                print(f"Error writing database, retrying in {retry_delay:.0f}s: {e}")
+                self._wakeup.set()
+
+    async def close(self):
+        """Stop the writer task, write anything still pending and release the backend."""
+        if self._writer is not None:
+            # Wait for a write in progress instead of cancelling it halfway; if it fails, its changes
+            # are back in the pending set for the flush below
+            async with self._write_lock:
+                self._writer.cancel()
+            self._writer = None
+        await self.flush()
+        self.backend.close()
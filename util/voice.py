@@ -0,0 +1,63 @@
+#***************************************************************************#
+# Underground Grotto
+#***************************************************************************#
+
+from array import array
+
+class VoiceSessions:
+    """Open voice sessions of one guild: who is earning voice XP and since when.
+
+    Users and start times are parallel array columns with a user ID ->
+    row dict; a session ending is swapped with the last row, so starting
+    and stopping are O(1) and nothing is touched while people just sit in
+    a channel.
+    """
+
+    __slots__ = ('rows', 'users', 'started')
+
+    def __init__(self):
+        self.rows = {}  # User ID -> row in users/started
+        self.users = array('Q')
+        self.started = array('d')
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __contains__(self, user_id):
+        return user_id in self.rows
+
+    def start(self, user_id, now):
+        if user_id in self.rows:
+            return
+        self.rows[user_id] = len(self.users)
+        self.users.append(user_id)
+        self.started.append(now)
+
+    def stop(self, user_id, now):
+        """End a session; returns its length in seconds, or None if the user had none."""
+        row = self.rows.pop(user_id, None)
+        if row is None:
+            return None
+        elapsed = now - self.started[row]
+        last = len(self.users) - 1
+        if row != last:
+            # Move the last session into the freed row
+            moved = self.users[last]
+            self.users[row] = moved
+            self.started[row] = self.started[last]
+            self.rows[moved] = row
+        del self.users[last]
+        del self.started[last]
+        return elapsed
+
+    def items(self):
+        """(user_id, start time) of every open session."""
+        return zip(self.users, self.started)
+
+    def stop_all(self, now):
+        """End every session; returns (user_id, seconds) for each."""
+        ended = [(user_id, now - started) for user_id, started in zip(self.users, self.started)]
+        self.rows.clear()
+        self.users = array('Q')
+        self.started = array('d')
+        return ended